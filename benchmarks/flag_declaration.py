@@ -0,0 +1,91 @@
+"""Benchmark the cost of declaring and registering flags.
+
+Compares the previous Flag() implementation, which injected its @provides
+methods into the calling class body via inspect.stack(), with the current one,
+which registers them when the module is first installed.
+
+    python benchmarks/flag_declaration.py --flags 300
+"""
+
+from __future__ import print_function
+
+import inspect
+import time
+from argparse import ArgumentParser
+
+from injector import Binder, Injector, Module as InjectorModule, provides, inject, singleton
+
+from waffle.flags import Flag, FlagKey, Flags, FlagsModule, Module, _ProvidedFlags, _ProvideFlag, _extract_dest
+
+
+def legacy_flag(*args, **kwargs):
+    """Flag() as it was implemented before frame-free registration."""
+    dest = _extract_dest(args, kwargs)
+
+    @provides(_ProvidedFlags)
+    def provide_flag(self):
+        return [(args, kwargs)]
+    provide_flag.__name__ = 'provides_flag_' + dest
+
+    @provides(FlagKey(dest), scope=singleton)
+    @inject(flags=Flags)
+    def provide_flag_value(self, flags):
+        return getattr(flags, dest)
+    provide_flag_value.__name__ = 'provides_flag_value_' + dest
+
+    frames = inspect.stack()
+    frames[1][0].f_locals[provide_flag.__name__] = provide_flag
+    frames[1][0].f_locals[provide_flag_value.__name__] = provide_flag_value
+
+    return _ProvideFlag(dest, *args, **kwargs)
+
+
+def declare_modules(flag, base, n_modules, n_flags):
+    modules = []
+    for i in range(n_modules):
+        # Flag() must be called from a class body for the legacy implementation.
+        namespace = {'flag': flag, 'Module': base, 'names': ['m%d_f%d' % (i, j) for j in range(n_flags)]}
+        exec('class M(Module):\n'
+             '    for name in names:\n'
+             '        locals()[name] = flag("--" + name, default=0, type=int)\n'
+             '    del name\n', namespace)
+        modules.append(namespace['M'])
+    return modules
+
+
+def install(modules):
+    injector = Injector([FlagsModule(['bench'])])
+    binder = injector.get(Binder)
+    for module in modules:
+        binder.install(module)
+    return injector
+
+
+def measure(flag, base, n_modules, n_flags, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        install(declare_modules(flag, base, n_modules, n_flags))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--flags', type=int, default=300, help='Total number of flags to declare.')
+    parser.add_argument('--modules', type=int, default=20, help='Number of modules to spread flags across.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs; the best is reported.')
+    args = parser.parse_args()
+
+    per_module = max(1, args.flags // args.modules)
+    before = measure(legacy_flag, InjectorModule, args.modules, per_module, args.repeat)
+    after = measure(Flag, Module, args.modules, per_module, args.repeat)
+    print('%d flags across %d modules' % (per_module * args.modules, args.modules))
+    print('  inspect.stack() registration: %8.2fms' % (before * 1000))
+    print('  frame-free registration:      %8.2fms' % (after * 1000))
+    print('  speedup:                      %8.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
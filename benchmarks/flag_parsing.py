@@ -0,0 +1,82 @@
+"""Benchmark resolving Flags for an application with many flags.
+
+Compares building an ArgumentParser and re-parsing synthesized "--k=v"
+defaults (the previous FlagsModule behaviour) with the precomputed flag table.
+
+    python benchmarks/flag_parsing.py --flags 200
+"""
+
+from __future__ import print_function
+
+import time
+from argparse import ArgumentParser
+
+from injector import Injector
+
+from waffle.flags import ArgumentDefaultsHelpFormatter, Flag, Flags, FlagsModule, Module, _ProvidedFlags
+
+
+def legacy_flags(flags, args, defaults):
+    """FlagsModule.provide_flags() as it was before the flag table."""
+    parser = ArgumentParser(fromfile_prefix_chars='@', formatter_class=ArgumentDefaultsHelpFormatter)
+    for flag_args, flag_kwargs in flags:
+        parser.add_argument(*flag_args, **flag_kwargs)
+    parser.set_defaults(**defaults)
+    default_args = []
+    for k, v in defaults.iteritems():
+        if isinstance(v, bool):
+            default_args.append('--%s' % k)
+        else:
+            default_args.append('--%s=%s' % (k, v))
+    return parser.parse_args(default_args + args[1:])
+
+
+def create_module(n_flags):
+    attrs = {}
+    for i in range(n_flags):
+        if i % 4 == 0:
+            attrs['f%d' % i] = Flag('--f%d' % i, action='store_true', help='Flag %d.' % i)
+        elif i % 4 == 1:
+            attrs['f%d' % i] = Flag('--f%d' % i, type=int, default='%d' % i, help='Flag %d.' % i)
+        else:
+            attrs['f%d' % i] = Flag('--f%d' % i, default='value', metavar='VALUE', help='Flag %d.' % i)
+    return type('ManyFlagsModule', (Module,), attrs)
+
+
+def best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--flags', type=int, default=200, help='Number of flags to declare.')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of runs; the best is reported.')
+    args = parser.parse_args()
+
+    module = create_module(args.flags)
+    argv = ['bench', '--f0', '--f1=10', '--f2', 'other']
+    defaults = {'f5': 5, 'f6': 'default'}
+
+    def before():
+        injector = Injector([FlagsModule(argv, defaults), module()])
+        legacy_flags(injector.get(_ProvidedFlags), argv, defaults)
+
+    def after():
+        Injector([FlagsModule(argv, defaults), module()]).get(Flags)
+
+    before_time = best_of(args.repeat, before)
+    after_time = best_of(args.repeat, after)
+    print('%d flags' % args.flags)
+    print('  ArgumentParser + synthesized defaults: %8.2fms' % (before_time * 1000))
+    print('  precomputed flag table:                %8.2fms' % (after_time * 1000))
+    print('  speedup:                               %8.1fx' % (before_time / after_time))
+
+
+if __name__ == '__main__':
+    main()
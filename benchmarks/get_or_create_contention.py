@@ -0,0 +1,129 @@
+"""Benchmark get_or_create() with many threads creating the same keys on SQLite.
+
+Compares the previous implementation, which inserts inside a SAVEPOINT and
+catches IntegrityError, with INSERT ... ON CONFLICT DO NOTHING.
+
+    python benchmarks/get_or_create_contention.py --threads 16 --keys 50
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+from injector import Injector
+from sqlalchemy import Column, Integer, String, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.sql.expression import ClauseElement
+
+from waffle.db import DatabaseEngine, DatabaseModule, DatabaseSession, Model
+from waffle.flags import FlagsModule
+
+
+class ContendedKey(Model):
+    id = Column(Integer, primary_key=True)
+    key = Column(String(32), unique=True, nullable=False)
+    value = Column(Integer)
+
+
+def legacy_get_or_create(cls, defaults={}, **kwargs):
+    """Model.get_or_create() as it was before ON CONFLICT support."""
+    with cls.query.session:
+        query = cls.query.filter_by(**kwargs)
+        instance = query.first()
+        if instance:
+            return instance, False
+        else:
+            with cls.query.session as session:
+                try:
+                    params = dict((k, v) for k, v in kwargs.iteritems() if not isinstance(v, ClauseElement))
+                    params.update(defaults)
+                    instance = cls(**params)
+                    session.add(instance)
+                    return instance, True
+                except IntegrityError:
+                    session.rollback()
+                    instance = query.one()
+                    return instance, False
+
+
+def create_session(path):
+    injector = Injector([FlagsModule(['bench', '--database_uri=sqlite:///' + path]), DatabaseModule])
+    engine = injector.get(DatabaseEngine)
+
+    # pysqlite does not emit BEGIN itself, which SAVEPOINT requires. BEGIN
+    # IMMEDIATE makes writers wait for each other rather than fail to upgrade
+    # their locks.
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN IMMEDIATE')
+
+    session = injector.get(DatabaseSession)
+    engine.dispose()
+    return session
+
+
+def run(session, get_or_create, threads, keys, iterations):
+    errors = []
+    created = []
+    names = ['key-%d' % i for i in range(keys)]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(iterations):
+            try:
+                with session:
+                    instance, was_created = get_or_create(ContendedKey, key=rng.choice(names),
+                                                          defaults={'value': seed})
+                if was_created:
+                    created.append(instance)
+            except (IntegrityError, OperationalError):
+                errors.append(seed)
+            finally:
+                session.remove()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    with session:
+        rows = ContendedKey.query.count()
+        ContendedKey.query.delete()
+    session.remove()
+    return elapsed, len(errors), rows
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16, help='Number of concurrent threads.')
+    parser.add_argument('--keys', type=int, default=50, help='Number of distinct keys.')
+    parser.add_argument('--iterations', type=int, default=200, help='Calls per thread.')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        session = create_session(path)
+        calls = args.threads * args.iterations
+        print('%d threads, %d keys, %d calls' % (args.threads, args.keys, calls))
+        for name, get_or_create in [('SAVEPOINT + IntegrityError', legacy_get_or_create),
+                                    ('INSERT ... ON CONFLICT', lambda cls, **kwargs: cls.get_or_create(**kwargs))]:
+            elapsed, errors, rows = run(session, get_or_create, args.threads, args.keys, args.iterations)
+            print('  %-28s %8.0f calls/s  %4d failed  %4d rows' % (name + ':', calls / elapsed, errors, rows))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Benchmark the time to resolve each name exported by the waffle package.
+
+Each name is resolved in a fresh interpreter, and compared with a baseline: a
+fresh interpreter importing injector and the optional dependencies the name
+imported. Names that take more than --budget times their baseline are marked,
+and make the exit status 1.
+
+    python benchmarks/import_time.py --budget 3
+"""
+
+from __future__ import print_function
+
+import sys
+from argparse import ArgumentParser
+
+import waffle
+from waffle.imports_test import HEAVY_PACKAGES, run_python
+
+
+MEASURE_IMPORT = r'''
+import json, sys, time
+
+start = time.time()
+import waffle
+getattr(waffle, sys.argv[1])
+total = (time.time() - start) * 1000
+json.dump({'total': total, 'packages': sorted(set(name.split('.')[0] for name in sys.modules))}, sys.stdout)
+'''
+
+MEASURE_BASELINE = r'''
+import json, sys, time
+
+start = time.time()
+for name in sys.argv[1:]:
+    __import__(name)
+json.dump((time.time() - start) * 1000, sys.stdout)
+'''
+
+
+def best_of(repeat, script, *args):
+    return min(run_python(script, *args) for _ in range(repeat))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=3.0, help='Maximum ratio of import time to baseline.')
+    parser.add_argument('--repeat', type=int, default=3, help='Report the best of this many runs.')
+    parser.add_argument('names', nargs='*', help='Names to measure. Defaults to all of waffle.__all__.')
+    args = parser.parse_args()
+
+    baselines = {}
+    over_budget = []
+    print('%-28s %10s %10s  %s' % ('name', 'import ms', 'base ms', 'optional dependencies'))
+    for name in args.names or sorted(waffle.__all__):
+        results = [run_python(MEASURE_IMPORT, name) for _ in range(args.repeat)]
+        total = min(result['total'] for result in results)
+        packages = tuple(sorted(set(results[0]['packages']) & HEAVY_PACKAGES))
+        if packages not in baselines:
+            baselines[packages] = best_of(args.repeat, MEASURE_BASELINE, 'injector', *packages)
+        baseline = baselines[packages]
+        marker = ''
+        if total > args.budget * baseline:
+            over_budget.append(name)
+            marker = '  over budget'
+        print('%-28s %10.1f %10.1f  %s%s' % (name, total, baseline, ', '.join(packages) or '-', marker))
+    if over_budget:
+        print('%d name(s) took more than %.1f times their baseline: %s' % (
+            len(over_budget), args.budget, ', '.join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Benchmark loading rows as ORM instances against Query.rows() and Query.tuples().
+
+Each run loads every row of a table in a read-only transaction and converts
+it to a dict, as a list endpoint would before serializing it to JSON.
+
+    python benchmarks/query_rows.py --rows 10000
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from injector import Injector
+from sqlalchemy import Column, DateTime, Integer, String
+
+from waffle.db import DatabaseEngine, DatabaseModule, DatabaseSession, Model
+from waffle.flags import FlagsModule
+
+
+class ListedItem(Model):
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32), nullable=False)
+    description = Column(String(200))
+    price = Column(Integer)
+    stock = Column(Integer)
+    created = Column(DateTime)
+
+
+COLUMNS = ['id', 'name', 'description', 'price', 'stock', 'created']
+
+
+def create_session(path, rows):
+    injector = Injector([FlagsModule(['bench', '--database_uri=sqlite:///' + path]), DatabaseModule])
+    session = injector.get(DatabaseSession)
+    engine = injector.get(DatabaseEngine)
+    now = datetime.datetime.utcnow()
+    engine.execute(ListedItem.__table__.insert(), [
+        {'name': 'item-%d' % i, 'description': 'Item number %d' % i, 'price': i * 100, 'stock': i % 17,
+         'created': now - datetime.timedelta(minutes=i)}
+        for i in range(rows)])
+    return session
+
+
+def load_instances():
+    return [dict((name, getattr(item, name)) for name in COLUMNS) for item in ListedItem.query]
+
+
+def load_rows():
+    return [dict(zip(row._fields, row)) for row in ListedItem.query.rows()]
+
+
+def load_tuples():
+    return [dict(zip(COLUMNS, row)) for row in ListedItem.query.with_entities(
+        *[getattr(ListedItem, name) for name in COLUMNS]).tuples()]
+
+
+def best_of(repeat, session, f):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        with session.readonly:
+            result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(result)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='Number of rows in the table.')
+    parser.add_argument('--repeat', type=int, default=5, help='Report the best of this many runs.')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        session = create_session(path, args.rows)
+        print('%d rows, %d columns' % (args.rows, len(COLUMNS)))
+        for name, f in [('ORM instances', load_instances), ('Query.rows()', load_rows),
+                        ('Query.tuples()', load_tuples)]:
+            elapsed, count = best_of(args.repeat, session, f)
+            print('  %-16s %8.1fms  %8.0f rows/s' % (name + ':', elapsed * 1000, count / elapsed))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,7 +32,8 @@ setup(
     author_email='alec@swapoff.org',
     install_requires=[
         'setuptools >= 0.6b1',
-        'injector',
+        # waffle.startup lists the bindings of an Injector, which has no public API.
+        'injector >= 0.9.1, < 0.10',
         'argh',
     ],
     cmdclass={'test': PyTest},
@@ -18,11 +18,14 @@ __version__ = '0.2.1'
 all_by_module = {
     'waffle.common':        ['AppModules'],
     'waffle.db':            ['DatabaseSession', 'Model', 'DatabaseModule',
-                             'DatabaseEngine', 'transaction', 'session_from'],
-    'waffle.flags':         ['Flags', 'Flag', 'FlagsModule', 'FlagDefaults', 'AppStartup',
-                             'FlagKey', 'flag', 'modules', 'main', 'create_injector_from_flags'],
+                             'DatabaseEngine', 'DatabasePoolStats', 'DatabaseReplicas', 'QueryCache',
+                             'QueryInstrumentation', 'QueryStats', 'transaction', 'session_from'],
+    'waffle.flags':         ['Flags', 'Flag', 'FlagsModule', 'FlagDefaults', 'AppStartup', 'Module',
+                             'Warmup', 'BeforeFork', 'AfterFork',
+                             'FlagKey', 'flag', 'modules', 'commands', 'main', 'create_injector_from_flags'],
     'waffle.devel':         ['DebugConsoleContext', 'DevelModule'],
     'waffle.redis':         ['RedisModule'],
+    'waffle.startup':       ['StartupError', 'WarmupError', 'startup_after', 'warm_up_singletons'],
     'waffle.util':          ['parse_reltime'],
     'waffle.log':           ['LogLevel', 'LoggingModule'],
     'waffle.template':      ['TemplateContext', 'TemplateGlobals', 'TemplateFilters',
@@ -33,6 +36,7 @@ all_by_module = {
                              'RenderFactory', 'SessionCookie', 'route', 'routes', 'request'],
     'waffle.web.csrf':      ['CsrfModule', 'csrf_exempt'],
     'waffle.web.db':        ['DatabaseSessionModule'],
+    'waffle.web.prefork':   ['PreforkServer'],
     'waffle.web.template':  ['WebTemplateModule'],
 }
 
@@ -1,12 +1,13 @@
 from injector import Module
 
-from waffle.db import DatabaseModule
-from waffle.log import LoggingModule
-from waffle.template import TemplateModule
-
 
 class AppModules(Module):
     def configure(self, binder):
+        # Imported here so that importing AppModules does not import SQLAlchemy and Jinja2.
+        from waffle.db import DatabaseModule
+        from waffle.log import LoggingModule
+        from waffle.template import TemplateModule
+
         binder.install(DatabaseModule)
         binder.install(LoggingModule)
         binder.install(TemplateModule)
@@ -4,17 +4,25 @@ import sys
 import logging
 
 import pytest
-from injector import Injector, Module
+from injector import Injector
 from sqlalchemy import Column, Integer, String, ForeignKey
 
 from waffle.db import DatabaseModule, DatabaseEngine, DatabaseSession, Model
-from waffle.flags import FlagKey
+from waffle.flags import FlagsModule
 
 
-class TestingModule(Module):
+class TestingModule(FlagsModule):
+    """Flags for tests: the defaults declared by modules, overridden by flags."""
+
+    def __init__(self, **flags):
+        # Record QueryStats, including statement shapes, without logging repeated statements.
+        defaults = {'database_uri': 'postgresql://localhost:5432/waffle', 'database_pool_size': 0,
+                    'database_query_stats': True, 'database_repeated_query_threshold': 1000}
+        defaults.update(flags)
+        super(TestingModule, self).__init__(['test'], defaults)
+
     def configure(self, binder):
-        binder.bind(FlagKey('database_uri'), to='postgresql://localhost:5432/waffle')
-        binder.bind(FlagKey('database_pool_size'), to=0)
+        super(TestingModule, self).configure(binder)
         stderr = logging.StreamHandler(sys.stderr)
         logging.getLogger('sqlalchemy').addHandler(stderr)
         logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
@@ -34,6 +42,7 @@ def db(request):
     engine = injector.get(DatabaseEngine)
     session = injector.get(DatabaseSession)
 
+    self.injector = injector
     self.session = session
 
     @request.addfinalizer
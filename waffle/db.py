@@ -1,20 +1,35 @@
+import cPickle as pickle
+import hashlib
 import inspect
+import itertools
+import math
+import re
+import sys
+import threading
+import time
 import types
 import logging
+from abc import ABCMeta, abstractmethod
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
 from functools import wraps
 
-from injector import Module, SequenceKey, inject, provides, singleton
+from injector import Injector, SequenceKey, inject, provides, singleton
 from sqlalchemy.engine import Engine as DatabaseEngine
-from sqlalchemy.orm import Query, sessionmaker, class_mapper
+from sqlalchemy.orm import Query, sessionmaker, class_mapper, object_mapper
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy import create_engine
-from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from sqlalchemy import Column, String, and_, create_engine, event, inspection, or_, pool, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DisconnectionError, InvalidRequestError, IntegrityError
 from sqlalchemy.orm.exc import UnmappedClassError
 from sqlalchemy.orm.session import Session
-from sqlalchemy.util import ThreadLocalRegistry
-from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.util import ScopedRegistry, ThreadLocalRegistry
+from sqlalchemy.schema import MetaData, Table
+from sqlalchemy.sql.expression import ClauseElement, Insert, UpdateBase
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.ext.compiler import compiles
 
-from waffle.flags import Flag
+from waffle.flags import BeforeFork, Flag, Module
 
 
 logger = logging.getLogger(__name__)
@@ -23,8 +38,70 @@ logger = logging.getLogger(__name__)
 DatabaseSession = Session
 DatabaseCreated = SequenceKey('DatabaseCreated')
 
+# Strategies for choosing the replica for each read-only transaction.
+REPLICA_STRATEGIES = ['least_connections', 'round_robin']
+
+# Values of --database_pool_class. "default" is the dialect's choice.
+POOL_CLASSES = {
+    'null': pool.NullPool,
+    'queue': pool.QueuePool,
+    'singleton_thread': pool.SingletonThreadPool,
+    'static': pool.StaticPool,
+}
+
+# SQLite's default limit on the number of parameters in a statement.
+MAX_BIND_PARAMS = 999
+
+# The internals of SQLAlchemy 0.8 that Query.rows() and tuples() use to execute their statement without the ORM's
+# row processing. If any are missing the query is iterated instead, which is slower.
+_FETCH_ROWS_INTERNALS = ('_autoflush', '_populate_existing', '_compile_context', '_connection_from_session',
+                         '_mapper_zero_or_none', '_params')
+
 
 class Query(Query):
+    _cache = None
+
+    def cached(self, ttl=60, key=None):
+        """Cache the result of this query for ttl seconds in the QueryCache.
+
+        The result is cached under the SQL and parameters of the query and the
+        entities it returns, within the namespace key if given. Cached results are discarded when a
+        transaction that changed any of the tables in the query commits.
+        Within a transaction that has changed those tables the cache is not
+        used.
+
+        Instances in a cached result are merged into the session without
+        loading them from the database, so they must be picklable and should
+        not be modified.
+        """
+        query = self._clone()
+        query._cache = (ttl, key)
+        return query
+
+    def __iter__(self):
+        cache = getattr(self.session, '_query_cache', None)
+        if self._cache is None or cache is None:
+            return super(Query, self).__iter__()
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+        statement = self.with_labels().statement
+        tables = sorted(set(table.name for table in find_tables(statement, check_columns=True,
+                                                                include_aliases=True, include_joins=True)
+                            if isinstance(table, Table)))
+        if self.session._written_tables.intersection(tables):
+            return super(Query, self).__iter__()
+        ttl, namespace = self._cache
+        compiled = statement.compile(dialect=self.session.get_bind().dialect)
+        # Queries with the same SQL may still differ in the shape of their result, eg. User vs. User.id, User.name.
+        shape = [(d['name'], repr(d['type'])) for d in self.column_descriptions]
+        key = cache.key('%s %s %r %r' % (namespace or '', compiled, sorted(compiled.params.items()), shape), tables)
+        result = cache.get(key)
+        if result is not None:
+            return self.merge_result(pickle.loads(result), load=False)
+        rows = list(super(Query, self).__iter__())
+        cache.set(key, pickle.dumps(rows, pickle.HIGHEST_PROTOCOL), ttl)
+        return iter(rows)
+
     def flatten(self):
         """Flatten row tuples to the first (and only) value."""
         return [i for i, in self]
@@ -33,29 +110,868 @@ class Query(Query):
         """Return list of values from column i in result."""
         return [r[i] for r in self]
 
+    def tuples(self):
+        """Return the result as a list of tuples of column values, without creating instances.
+
+        For a query of one model, eg. User.query, each tuple holds the values
+        of the model's (non-deferred) column attributes, in mapper order.
+        Otherwise a tuple holds a value per entity of the query, where the
+        value for a model is such a tuple.
+
+        No instances are created, added to the identity map or tracked for
+        changes, which makes this much cheaper than iterating the query when
+        the result is only read (eg. serialized). Relationships are not
+        loaded, and the result is not cached by cached().
+        """
+        return self._fetch_rows(named=False)
+
+    def rows(self):
+        """Like tuples(), but return named tuples, eg. [user.name for user in User.query.rows()].
+
+        The fields of a model's row are its attribute names, and the fields
+        of other rows are the names of their entities.
+        """
+        return self._fetch_rows(named=True)
+
+    def _fetch_rows(self, named):
+        names = []
+        # For each entity, the field names of a model or None for a column.
+        fields = []
+        columns = []
+        for description in self.column_descriptions:
+            if isinstance(description['type'], type):
+                # A Mapper, or an AliasedInsp for aliased models.
+                entity = inspection.inspect(description['expr'])
+                keys = [prop.key for prop in entity.mapper.column_attrs if not prop.deferred]
+                columns.extend(getattr(entity.entity, key) for key in keys)
+                fields.append(keys)
+            else:
+                columns.append(description['expr'])
+                fields.append(None)
+            names.append(description['name'])
+
+        # Labelled, as the statement would otherwise select a column repeated between entities only once.
+        query = self.enable_eagerloads(False).with_entities(*[column.label('_%d' % i)
+                                                              for i, column in enumerate(columns)])
+        if all(hasattr(query, name) for name in _FETCH_ROWS_INTERNALS):
+            if self._autoflush and not self._populate_existing:
+                self.session._autoflush()
+            context = query._compile_context()
+            context.statement.use_labels = True
+            conn = query._connection_from_session(mapper=self._mapper_zero_or_none(), clause=context.statement,
+                                                  close_with_result=True)
+            # The statement may select extra columns after those of the entities, eg. for DISTINCT ... ORDER BY.
+            rows = [tuple(row)[:len(columns)] for row in conn.execute(context.statement, query._params)]
+        else:
+            rows = [tuple(row) for row in super(Query, query).__iter__()]
+
+        if len(fields) == 1 and fields[0] is not None:
+            if named:
+                row_class = _row_class(fields[0])
+                rows = [tuple.__new__(row_class, row) for row in rows]
+            return rows
+
+        row_class = _row_class(names) if named else tuple
+        if all(keys is None for keys in fields):
+            return [tuple.__new__(row_class, row) for row in rows]
+        slices = []
+        offset = 0
+        for keys in fields:
+            if keys is None:
+                slices.append((offset, None, None))
+                offset += 1
+            else:
+                slices.append((offset, offset + len(keys), _row_class(keys) if named else tuple))
+                offset += len(keys)
+        return [tuple.__new__(row_class, [row[start] if end is None else tuple.__new__(entity_class, row[start:end])
+                                          for start, end, entity_class in slices])
+                for row in rows]
+
+    def stream(self, batch_size=1000):
+        """Iterate over the result, fetching batch_size rows at a time.
+
+        Uses a server-side cursor where the dialect supports one (eg. psycopg2),
+        so memory use does not grow with the size of the result. The result must
+        be consumed within the transaction the query was made in.
+
+        As with yield_per(), eagerly loaded collections should not be used, and
+        changes to an instance may be overwritten if it appears in a later batch.
+        """
+        return iter(self.yield_per(batch_size))
+
+    def stream_flatten(self, batch_size=1000):
+        """Like flatten(), but yields values as they are fetched. See :meth:`stream`."""
+        for i, in self.stream(batch_size):
+            yield i
+
+    def stream_column(self, i, batch_size=1000):
+        """Like column(), but yields values as they are fetched. See :meth:`stream`."""
+        for r in self.stream(batch_size):
+            yield r[i]
+
+
+_row_classes = {}
+
+
+def _row_class(names):
+    """Return a namedtuple class with fields names, for Query.rows()."""
+    names = tuple(names)
+    try:
+        return _row_classes[names]
+    except KeyError:
+        # Unnamed columns (eg. literals) are renamed to _0, _1, ...
+        row_class = namedtuple('Row', [name or '_' for name in names], rename=True)
+        _row_classes[names] = row_class
+        return row_class
+
+
+class QueryCache(object):
+    """A cache of query results, used by :meth:`Query.cached`.
+
+    Each table has a generation, which is part of the key of every cached
+    result that reads from that table. Invalidating a table increments its
+    generation, so that results cached before then are no longer used.
+
+    Counts hits and misses. Subclasses implement storage with _get(), set(),
+    generations() and invalidate().
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, key, tables):
+        """Return the cache key for a query identified by key, which reads from tables."""
+        generations = self.generations(tables)
+        return hashlib.sha1('%s %r' % (key, zip(tables, generations))).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        value = self._get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Cache value under key for ttl seconds."""
+
+    @abstractmethod
+    def generations(self, tables):
+        """Return the current generation of each table."""
+
+    @abstractmethod
+    def invalidate(self, tables):
+        """Discard cached results that read from any of tables."""
+
+    @abstractmethod
+    def _get(self, key):
+        """Return the cached value for key, or None, without counting it as a hit or miss."""
+
+
+class LRUQueryCache(QueryCache):
+    """An in-process QueryCache holding up to max_size results, discarding the least recently used."""
+
+    def __init__(self, max_size=10000):
+        super(LRUQueryCache, self).__init__()
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def generations(self, tables):
+        with self._lock:
+            return [self._generations.get(table, 0) for table in tables]
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+
+class RedisQueryCache(QueryCache):
+    """A QueryCache shared between processes through Redis.
+
+    Results expire after their TTL, and are otherwise evicted according to
+    the Redis server's maxmemory-policy.
+    """
+
+    def __init__(self, redis, prefix='waffle:query:'):
+        super(RedisQueryCache, self).__init__()
+        self.redis = redis
+        self.prefix = prefix
+
+    def _get(self, key):
+        return self.redis.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.redis.set(self.prefix + key, value, ex=int(math.ceil(ttl)))
+
+    def generations(self, tables):
+        if not tables:
+            return []
+        return [int(generation or 0) for generation in
+                self.redis.mget([self.prefix + 'generation:' + table for table in tables])]
+
+    def invalidate(self, tables):
+        pipeline = self.redis.pipeline(transaction=False)
+        for table in tables:
+            pipeline.incr(self.prefix + 'generation:' + table)
+        pipeline.execute()
+
+
+class _InsertOnConflict(Insert):
+    """An INSERT ... ON CONFLICT statement, for PostgreSQL >= 9.5 and SQLite >= 3.24.
+
+    Conflicting rows have the columns in update set to the values being
+    inserted, or are skipped if update is empty. With returning, the
+    statement returns every column of the rows it inserts or updates (see
+    _supports_returning()).
+    """
+
+    def __init__(self, table, values, conflict_columns=(), update=(), returning=False):
+        super(_InsertOnConflict, self).__init__(table, values, inline=True)
+        self.conflict_columns = conflict_columns
+        self.update = update
+        if returning:
+            # What Insert.returning() sets, so that SQLAlchemy keeps the result open.
+            self._returning = tuple(table.c)
+
+
+@compiles(_InsertOnConflict)
+def _compile_insert_on_conflict(insert, compiler, **kw):
+    # RETURNING is compiled here, as SQLAlchemy would place it before ON CONFLICT and does not support it for SQLite.
+    text = compiler.visit_insert(Insert(insert.table, insert.parameters, inline=True), **kw)
+    columns = dict((name, compiler.preparer.format_column(insert.table.c[name]))
+                   for name in list(insert.conflict_columns) + list(insert.update))
+    target = ''
+    if insert.conflict_columns:
+        target = ' (%s)' % ', '.join(columns[name] for name in insert.conflict_columns)
+    if not insert.update:
+        text = '%s ON CONFLICT%s DO NOTHING' % (text, target)
+    else:
+        assignments = ', '.join('%s = excluded.%s' % (columns[name], columns[name]) for name in insert.update)
+        text = '%s ON CONFLICT%s DO UPDATE SET %s' % (text, target, assignments)
+    if insert._returning:
+        text += ' RETURNING ' + ', '.join(compiler.preparer.format_column(column) for column in insert._returning)
+    return text
+
+
+def _column_values(cls, values):
+    """Map the attribute names of values to the keys of columns of cls.__table__.
+
+    Returns None if any name is not a plain column attribute of the table (eg.
+    a relationship), or any value is a SQL expression.
+    """
+    mapper = class_mapper(cls)
+    columns = {}
+    for name, value in values.iteritems():
+        if name not in mapper.column_attrs or isinstance(value, ClauseElement):
+            return None
+        prop_columns = mapper.column_attrs[name].columns
+        if len(prop_columns) != 1 or prop_columns[0].table is not cls.__table__:
+            return None
+        columns[prop_columns[0].key] = value
+    return columns
+
+
+def _supports_on_conflict(dialect):
+    if dialect.name == 'postgresql':
+        return dialect.server_version_info >= (9, 5)
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24)
+    return False
+
+
+def _supports_returning(dialect):
+    """Whether _InsertOnConflict supports returning, given that the dialect supports ON CONFLICT."""
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 35)
+    return True
+
+
+class DatabasePoolStats(object):
+    """Connection pool statistics for the DatabaseEngine.
+
+    - checked_out: connections currently checked out of the pool.
+    - overflow: connections open beyond --database_pool_size (QueuePool only).
+    - checkouts: connections successfully checked out.
+    - checkout_failures: attempts to check out a connection that failed,
+      including those that timed out waiting for the pool.
+    - wait_histogram(): the distribution of time taken to check out a
+      connection, including connecting to the database if necessary.
+    """
+
+    # Upper bounds, in milliseconds, of the wait_histogram() buckets.
+    WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engine = None
+        self._checked_out = set()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self._waits = [0] * len(self.WAIT_BUCKETS_MS)
+
+    def attach(self, engine):
+        """Collect statistics for engine, which must use a pool class from pool_class()."""
+        self._engine = engine
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+
+    def pool_class(self, cls):
+        """Return a subclass of the pool class cls that times checkouts."""
+        def timed(method):
+            @wraps(method)
+            def wrapper(instance):
+                start = time.time()
+                try:
+                    connection = method(instance)
+                except Exception:
+                    self._waited(time.time() - start, failed=True)
+                    raise
+                self._waited(time.time() - start)
+                return connection
+            return wrapper
+
+        return type(cls.__name__, (cls,), {'connect': timed(cls.connect),
+                                           'unique_connection': timed(cls.unique_connection)})
+
+    @property
+    def checked_out(self):
+        return len(self._checked_out)
+
+    @property
+    def overflow(self):
+        engine_pool = self._engine.pool if self._engine is not None else None
+        if isinstance(engine_pool, pool.QueuePool):
+            return max(0, engine_pool.overflow())
+        return 0
+
+    def wait_histogram(self):
+        """Return a list of (upper bound in ms, number of checkouts)."""
+        with self._lock:
+            return zip(self.WAIT_BUCKETS_MS, self._waits)
+
+    def _waited(self, seconds, failed=False):
+        ms = seconds * 1000
+        with self._lock:
+            if failed:
+                self.checkout_failures += 1
+            else:
+                self.checkouts += 1
+            for i, bound in enumerate(self.WAIT_BUCKETS_MS):
+                if ms <= bound:
+                    self._waits[i] += 1
+                    break
+
+    # Connections are tracked by record, as a connection that fails to check
+    # out (eg. with --database_pool_pre_ping) is still checked in.
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self._checked_out.add(id(connection_record))
+
+    def _checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._checked_out.discard(id(connection_record))
+
+    def __repr__(self):
+        return 'DatabasePoolStats(checked_out=%d, overflow=%d, checkouts=%d, checkout_failures=%d)' % (
+            self.checked_out, self.overflow, self.checkouts, self.checkout_failures)
+
+
+def _statement_shape(statement):
+    """Normalise a statement, replacing literal numbers and strings with ?."""
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\b\d+(?:\.\d+)?\b', '?', statement)
+    return ' '.join(statement.split())
+
+
+class _GreenletLocalRegistry(ThreadLocalRegistry):
+    """A registry holding a value per greenlet, discarded when the greenlet exits. Requires gevent."""
+
+    def __init__(self, createfunc):
+        from gevent.local import local
+        self.createfunc = createfunc
+        self.registry = local()
+
+
+# Registries for each value of --database_session_scope.
+SESSION_SCOPES = {
+    'greenlet': _GreenletLocalRegistry,
+    'thread': ThreadLocalRegistry,
+}
+
+
+def _create_registry(scope, createfunc):
+    """Create a registry of values created by createfunc, one per scope.
+
+    scope is a key of SESSION_SCOPES, or a function returning a hashable
+    identifying the current scope. Values of a scope function must be
+    cleared explicitly.
+    """
+    if callable(scope):
+        return ScopedRegistry(createfunc, scope)
+    return SESSION_SCOPES[scope](createfunc)
+
+
+def _gevent_wait_callback(connection, timeout=None):
+    """A psycopg2 wait callback that yields to other greenlets while waiting for the server."""
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise OperationalError('Bad result from poll: %r' % state)
+
+
+def make_driver_cooperative(dialect):
+    """Make database I/O of dialect's driver yield to other greenlets.
+
+    psycopg2 is given a gevent wait callback. Pure-Python drivers (eg.
+    pymysql) are cooperative once gevent has patched the socket module.
+    """
+    if dialect.driver == 'psycopg2':
+        from psycopg2 import extensions
+        extensions.set_wait_callback(_gevent_wait_callback)
+        return
+    from gevent import monkey
+    if not monkey.is_module_patched('socket'):
+        logger.warning('The %s driver is not cooperative unless gevent.monkey.patch_all() is called at startup',
+                       dialect.driver)
+
+
+class QueryStats(object):
+    """The statements executed within a request or an outermost "with session:" block.
+
+    - count: the number of statements.
+    - time: the total time spent executing them, in milliseconds.
+    - slowest: up to max_slowest (milliseconds, statement) pairs, slowest first.
+    - shapes: a Counter of statements, with literal values replaced by ?, if
+      record_shapes (as it is when repeated statements are detected).
+    - savepoints: the number of SAVEPOINTs issued by nested "with session:" blocks.
+    - savepoint_sites: a Counter of the code ("file:line function") entering those blocks.
+    """
+
+    def __init__(self, max_slowest=5, record_shapes=True):
+        self.max_slowest = max_slowest
+        self.record_shapes = record_shapes
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+        self.shapes = Counter()
+        self.savepoints = 0
+        self.savepoint_sites = Counter()
+
+    def add(self, statement, ms):
+        self.count += 1
+        self.time += ms
+        if self.record_shapes:
+            self.shapes[_statement_shape(statement)] += 1
+        if len(self.slowest) < self.max_slowest or ms > self.slowest[-1][0]:
+            self.slowest.append((ms, statement))
+            self.slowest.sort(key=lambda slow: -slow[0])
+            del self.slowest[self.max_slowest:]
+
+    def add_savepoint(self, site):
+        self.savepoints += 1
+        self.savepoint_sites[site] += 1
+
+    def repeated(self, threshold):
+        """Return (shape, count) for statements executed more than threshold times, most frequent first."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+    def __repr__(self):
+        return 'QueryStats(count=%d, time=%.1fms, savepoints=%d)' % (self.count, self.time, self.savepoints)
+
+
+class QueryInstrumentation(object):
+    """Records the statements executed by an engine in the active QueryStats of each thread.
+
+    Statements slower than slow_query_ms are logged. When the outermost
+    QueryStats of a thread ends, statements executed more than
+    repeated_query_threshold times are logged as likely N+1 queries, eg. a
+    lazy-loaded relationship accessed in a loop. Either is disabled if 0.
+
+    QueryStats are only recorded if record_stats or the repeated statement
+    threshold is set, and statement shapes only if the latter. If nothing is
+    recorded or logged the engine is not instrumented at all.
+    """
+
+    def __init__(self, slow_query_ms=0, repeated_query_threshold=0, scope='thread', record_stats=False):
+        self.slow_query_ms = slow_query_ms
+        self.repeated_query_threshold = repeated_query_threshold
+        self.recording = bool(record_stats or repeated_query_threshold)
+        self._stacks = _create_registry(scope, list)
+
+    def attach(self, engine):
+        if not (self.recording or self.slow_query_ms):
+            return
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'dbapi_error', self._dbapi_error)
+
+    @property
+    def _stack(self):
+        return self._stacks() if self._stacks.has() else []
+
+    @property
+    def current(self):
+        """The outermost active QueryStats of this thread, or None."""
+        stack = self._stack
+        return stack[0] if stack else None
+
+    def begin(self, stats=None):
+        """Start recording statements executed by this thread. Must be followed by end().
+
+        Returns the QueryStats, or None if not recording.
+        """
+        if not self.recording:
+            return None
+        stats = stats or QueryStats(record_shapes=bool(self.repeated_query_threshold))
+        self._stacks().append(stats)
+        return stats
+
+    def end(self, stats):
+        if stats is None:
+            return
+        stack = self._stack
+        stack.remove(stats)
+        if stack:
+            return
+        self._stacks.clear()
+        logger.debug('%d statements in %.1fms, %d savepoints', stats.count, stats.time, stats.savepoints)
+        if self.repeated_query_threshold:
+            for shape, count in stats.repeated(self.repeated_query_threshold):
+                logger.warning('Statement executed %d times, possibly an N+1 query: %s', count, shape)
+
+    @contextmanager
+    def record(self, stats=None):
+        """Record statements executed by this thread in the block, if recording.
+
+            with instrumentation.record() as stats:
+                ...
+        """
+        stats = self.begin(stats)
+        try:
+            yield stats
+        finally:
+            self.end(stats)
+
+    def savepoint(self, site):
+        """Record a SAVEPOINT issued by a block entered at site."""
+        for stats in self._stack:
+            stats.add_savepoint(site)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        ms = (time.time() - conn.info['query_start_time'].pop()) * 1000
+        for stats in self._stack:
+            stats.add(statement, ms)
+        if self.slow_query_ms and ms >= self.slow_query_ms:
+            logger.warning('Slow query (%.1fms): %s', ms, ' '.join(statement.split()))
+
+    def _dbapi_error(self, conn, cursor, statement, parameters, context, exception):
+        start_times = conn.info.get('query_start_time')
+        if start_times:
+            start_times.pop()
+
+
+class DatabaseReplicas(object):
+    """Chooses a read replica engine for each read-only transaction.
+
+    With the "round_robin" strategy replicas are used in turn. With
+    "least_connections" the replica with the fewest read-only transactions in
+    progress in this process is used, in turn if several are tied.
+    """
+
+    def __init__(self, engines, strategy='round_robin'):
+        if strategy not in REPLICA_STRATEGIES:
+            raise ValueError('Unknown replica strategy %r, expected one of %s'
+                             % (strategy, ', '.join(REPLICA_STRATEGIES)))
+        self.engines = list(engines)
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._in_use = [0] * len(self.engines)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def acquire(self):
+        """Choose a replica for a transaction. Must be followed by release()."""
+        with self._lock:
+            start = next(self._next) % len(self.engines)
+            order = range(start, len(self.engines)) + range(start)
+            if self.strategy == 'least_connections':
+                index = min(order, key=lambda i: self._in_use[i])
+            else:
+                index = start
+            self._in_use[index] += 1
+            return self.engines[index]
+
+    def release(self, engine):
+        with self._lock:
+            self._in_use[self.engines.index(engine)] -= 1
+
+    def in_use(self):
+        """Return a list of (engine, number of transactions in progress)."""
+        with self._lock:
+            return zip(self.engines, self._in_use)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+# Statements marking the current transaction read-only, by dialect.
+READ_ONLY_TRANSACTION = {
+    'postgresql': 'SET TRANSACTION READ ONLY',
+    'mysql': 'SET TRANSACTION READ ONLY',
+}
+
+
+class _Transaction(object):
+    """A context manager for a transaction of a session, with options (eg. readonly=True)."""
+
+    def __init__(self, session, **options):
+        self._session = session
+        self._options = options
+
+    def __enter__(self):
+        return self._session._enter(**self._options)
+
+    def __exit__(self, type, value, traceback):
+        return self._session.__exit__(type, value, traceback)
+
 
 class ExplicitSession(Session):
     def __init__(self, *args, **kwargs):
+        self._replicas = kwargs.pop('replicas', None)
+        self._query_cache = kwargs.pop('query_cache', None)
+        self._instrumentation = kwargs.pop('instrumentation', None)
+        self._join_nested = kwargs.pop('join_nested', False)
         super(ExplicitSession, self).__init__(*args, **kwargs)
         self._depth = 0
+        # For each nested block, whether it began a nested transaction (a SAVEPOINT).
+        self._nested = []
+        self._savepoint_sites = {}
+        self._readonly = False
+        # The identity keys of instances in the session when a read-only transaction began.
+        self._readonly_keys = None
+        self._default_autoflush = self.autoflush
+        self._replica = None
+        self._query_stats = None
+        # The ModelLoader of each model class, for the outermost transaction.
+        self._loaders = {}
+        # Tables changed in the current transaction, invalidated in the query cache on commit.
+        self._written_tables = set()
+
+    @property
+    def readonly(self):
+        """A context manager for a read-only transaction. See :meth:`ExplicitSessionManager.readonly`."""
+        return _Transaction(self, readonly=True)
+
+    def join(self):
+        """A context manager for a block joining the transaction. See :meth:`ExplicitSessionManager.join`."""
+        return _Transaction(self, join=True)
+
+    def savepoint(self):
+        """A context manager for a block with a savepoint. See :meth:`ExplicitSessionManager.savepoint`."""
+        return _Transaction(self, join=False)
 
     def __enter__(self):
+        return self._enter()
+
+    def _enter(self, readonly=False, join=None):
+        # A connection is not checked out, and BEGIN or SAVEPOINT not
+        # issued, until the transaction executes its first statement.
         self._depth += 1
         if self._depth == 1:
-            self.begin()
+            self._readonly = readonly
+            if readonly:
+                self._readonly_keys = set(self.identity_map)
+                self.autoflush = False
+            if self._instrumentation is not None:
+                self._query_stats = self._instrumentation.begin()
+            try:
+                self.begin()
+            except BaseException:
+                self._depth -= 1
+                self._end_outermost()
+                raise
+        elif self._join_nested if join is None else join:
+            self._nested.append(False)
         else:
-            self.begin_nested()
+            transaction = self.begin_nested()
+            self._nested.append(True)
+            if self._query_stats is not None:
+                self._savepoint_sites[transaction] = _caller_site()
         return self
 
     def __exit__(self, type, value, traceback):
         self._depth -= 1
-        if self.transaction is not None:
-            self.transaction.__exit__(type, value, traceback)
+        try:
+            # Joined blocks leave the transaction, and any exception, to the enclosing block.
+            if (not self._depth or self._nested.pop()) and self.transaction is not None:
+                self._savepoint_sites.pop(self.transaction, None)
+                if not self._depth and self._readonly and type is None:
+                    self._end_readonly()
+                else:
+                    self.transaction.__exit__(type, value, traceback)
+        finally:
+            if not self._depth:
+                self._end_outermost()
+
+    def _end_readonly(self):
+        # There is nothing to flush or commit, so the transaction is closed,
+        # which releases the connection without COMMIT or expiring instances.
+        # Instances loaded by it are then expunged, so later flushes in the
+        # session do not check them for changes.
+        changed = not self._is_clean()
+        if changed:
+            self.transaction.rollback()
+        else:
+            self.transaction.close()
+        loaded = [state.obj() for state in self.identity_map.all_states() if state.key not in self._readonly_keys]
+        for instance in loaded:
+            if instance is not None and instance in self:
+                self.expunge(instance)
+        if changed:
+            raise InvalidRequestError('Can not change instances in a read-only transaction')
+
+    def _end_outermost(self):
+        self._loaders.clear()
+        if self._readonly:
+            self._readonly_keys = None
+            self.autoflush = self._default_autoflush
+        self._readonly = False
+        if self._replica is not None:
+            self._replicas.release(self._replica)
+            self._replica = None
+        if self._query_stats is not None:
+            self._instrumentation.end(self._query_stats)
+            self._query_stats = None
+
+    def loader(self, model):
+        """The ModelLoader for model, shared by the outermost transaction in progress."""
+        try:
+            return self._loaders[model]
+        except KeyError:
+            loader = self._loaders[model] = ModelLoader(model)
+            return loader
+
+    @property
+    def query_stats(self):
+        """The QueryStats of the outermost transaction in progress, or None."""
+        return self._query_stats
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._readonly and self._replicas:
+            # The replica is chosen by the first statement of the transaction.
+            if self._replica is None:
+                self._replica = self._replicas.acquire()
+            return self._replica
+        return super(ExplicitSession, self).get_bind(mapper, clause)
+
+    def execute(self, clause, *args, **kwargs):
+        if isinstance(clause, UpdateBase):
+            if self._readonly:
+                raise InvalidRequestError('Can not execute %s in a read-only transaction' % type(clause).__name__)
+            if self._query_cache is not None:
+                self._written_tables.add(clause.table.name)
+        return super(ExplicitSession, self).execute(clause, *args, **kwargs)
+
+    def flush(self, objects=None):
+        if self._readonly and not self._is_clean():
+            raise InvalidRequestError('Can not flush changes in a read-only transaction')
+        return super(ExplicitSession, self).flush(objects)
+
+    def _record_flushed_tables(self):
+        if self._query_cache is not None:
+            for instance in list(self.new) + list(self.dirty) + list(self.deleted):
+                self._written_tables.update(table.name for table in object_mapper(instance).tables)
+
+    def _after_begin(self, transaction, connection):
+        if transaction.nested:
+            if self._query_stats is not None:
+                self._instrumentation.savepoint(self._savepoint_sites.get(transaction, 'unknown'))
+        elif self._readonly:
+            statement = READ_ONLY_TRANSACTION.get(connection.dialect.name)
+            if statement:
+                connection.execute(statement)
+
+    def _after_soft_rollback(self):
+        # Rolling back a savepoint keeps the tables written before it, which
+        # must still be invalidated if the enclosing transaction commits.
+        if self.transaction is None:
+            self._written_tables.clear()
+
+    def _after_commit(self):
+        # after_commit also fires when a savepoint is released, while the
+        # enclosing transaction may still roll back its writes.
+        if self._written_tables and not self.transaction.nested:
+            self._query_cache.invalidate(sorted(self._written_tables))
+            self._written_tables.clear()
+
+
+# Listen on the class, as listening on each session adds to the cost of creating it.
+event.listen(ExplicitSession, 'after_flush', lambda session, flush_context: session._record_flushed_tables())
+event.listen(ExplicitSession, 'after_commit', lambda session: session._after_commit())
+event.listen(ExplicitSession, 'after_soft_rollback',
+             lambda session, previous_transaction: session._after_soft_rollback())
+event.listen(ExplicitSession, 'after_begin',
+             lambda session, transaction, connection: session._after_begin(transaction, connection))
+
+
+def _caller_site():
+    """Return "file:line function" of the innermost caller outside this module."""
+    frame = sys._getframe(1)
+    while frame.f_back is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    return '%s:%d %s' % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
 
 
 class ExplicitSessionManager(object):
     """A thread-safe explicit session manager.
 
+    There is a session per thread, or per scope given by the scope argument
+    (see :func:`_create_registry`), eg. 'greenlet'.
+
     This provides the following semantics:
 
     - Sessions are started via a contextmanager.
@@ -63,25 +979,69 @@ class ExplicitSessionManager(object):
     - Entering a Session context opens a transaction and returns a session recursively.
     - Provides a query_property that can only be used within a transaction.
     - A transaction can *only* be opened by a context manager.
+    - Outermost transactions opened with "with session.readonly:" use a read replica, if any.
     """
 
-    def __init__(self, session_factory):
+    def __init__(self, session_factory, scope='thread'):
         self._session_factory = session_factory
-        self._registry = ThreadLocalRegistry(session_factory)
+        self._registry = _create_registry(scope, session_factory)
 
     def configure(self, **config):
         self._session_factory.configure(**config)
 
     def __enter__(self):
+        return self._enter()
+
+    def _enter(self, **options):
         if not self._registry.has():
             sess = self._session_factory()
             self._registry.set(sess)
         else:
             sess = self._registry()
-        return sess.__enter__()
+        return sess._enter(**options)
+
+    def begin(self, readonly=False):
+        return self._enter(readonly=readonly)
+
+    @property
+    def readonly(self):
+        """A context manager for a transaction that only reads.
+
+            with session.readonly:
+                ...
+
+        Autoflush is off, and on PostgreSQL and MySQL the database
+        transaction is read-only. Changing instances or executing INSERT,
+        UPDATE or DELETE raises InvalidRequestError. The transaction ends
+        without a flush or COMMIT, and instances it loaded are expunged from
+        the session, with their loaded attributes, so that later flushes do
+        not track them for changes. Use merge() to modify them in a later
+        transaction.
+
+        If --database_replica_uris is set, the transaction runs on a read
+        replica. Transactions nested within it stay on that replica, and
+        read-only transactions nested within other transactions stay on the
+        primary, so reads following writes see those writes. Nested
+        read-only transactions are ordinary savepoints.
+        """
+        return _Transaction(self, readonly=True)
+
+    def join(self):
+        """A context manager for a block that joins the enclosing transaction, without a savepoint.
 
-    def begin(self):
-        return self.__enter__()
+            with session:
+                with session.join():
+                    ...
+
+        An exception raised in the block rolls back the whole transaction, if
+        it is not caught before leaving the enclosing block. Outside a
+        transaction this is the same as "with session:".
+        """
+        return _Transaction(self, join=True)
+
+    def savepoint(self):
+        """A context manager for a block with a savepoint, even if --database_join_nested is set."""
+        return _Transaction(self, join=False)
 
     def __exit__(self, type, value, traceback):
         if self._registry.has():
@@ -94,6 +1054,33 @@ class ExplicitSessionManager(object):
             self._registry().close()
         self._registry.clear()
 
+    def spawn(self, f, *args, **kwargs):
+        """Call f(*args, **kwargs) in a new greenlet, within a transaction of its own session.
+
+        The transaction is read-only if f is decorated with
+        @transaction(readonly=True). Returns the gevent Greenlet, whose get()
+        returns the result of f:
+
+            users = [session.spawn(load_user, id) for id in ids]
+            gevent.joinall(users, raise_error=True)
+
+        Requires sessions scoped to greenlets (see --database_cooperative).
+        """
+        import gevent
+        from gevent import monkey
+        if type(self._registry) is ThreadLocalRegistry and not monkey.is_module_patched('threading'):
+            raise InvalidRequestError('spawn() requires a session per greenlet, use --database_session_scope=greenlet')
+        readonly = getattr(f, '__transaction_readonly__', False)
+
+        def run():
+            try:
+                with self.readonly if readonly else self:
+                    return f(*args, **kwargs)
+            finally:
+                self.remove()
+
+        return gevent.spawn(run)
+
     def query_property(self, query_cls=None):
         class query(object):
             def __get__(s, instance, owner):
@@ -119,6 +1106,80 @@ class ExplicitSessionManager(object):
         return getattr(self._registry(), name)
 
 
+class _Loading(object):
+    """An instance requested from a ModelLoader, loaded on the first call to get()."""
+
+    def __init__(self, loader, id):
+        self._loader = loader
+        self._id = id
+
+    def get(self):
+        return self._loader.get(self._id)
+
+    def __repr__(self):
+        return '_Loading(%s, %r)' % (self._loader.model.__name__, self._id)
+
+
+class ModelLoader(object):
+    """Load instances of a model by primary key, batching the lookups into one query.
+
+    load(id) records the id, and returns an object whose get() returns the
+    instance, or None if there is no such row. The first get() loads all ids
+    recorded so far with one "WHERE id IN (...)" query, so loops like this
+    issue one SELECT rather than one per user:
+
+        loader = Address.loader()
+        pending = [loader.load(user.address_id) for user in users]
+        addresses = [p.get() for p in pending]
+
+    Loaded instances, and ids that were not found, are remembered until the
+    outermost transaction ends, so rows inserted or deleted in the meantime
+    are not seen.
+    """
+
+    def __init__(self, model):
+        mapper = class_mapper(model)
+        if len(mapper.primary_key) != 1:
+            raise InvalidRequestError('%s has a composite primary key, which ModelLoader does not support'
+                                      % model.__name__)
+        self.model = model
+        self._column = mapper.primary_key[0]
+        self._key = mapper.get_property_by_column(self._column).key
+        self._pending = OrderedDict()
+        self._loaded = {}
+
+    def load(self, id):
+        """Record id to be loaded by the next query."""
+        if id not in self._loaded:
+            self._pending[id] = True
+        return _Loading(self, id)
+
+    def load_many(self, ids):
+        """Return a list of the instances (or None) with ids, loading those not already loaded."""
+        ids = list(ids)
+        for id in ids:
+            self.load(id)
+        return [self.get(id) for id in ids]
+
+    def get(self, id):
+        """Return the instance with id, or None, loading it and any other recorded ids if needed."""
+        if id not in self._loaded:
+            self.load(id)
+            self.dispatch()
+        return self._loaded[id]
+
+    def dispatch(self):
+        """Load the recorded ids."""
+        ids = [id for id in self._pending if id is not None]
+        self._pending.clear()
+        for id in ids:
+            self._loaded[id] = None
+        self._loaded[None] = None
+        for i in range(0, len(ids), MAX_BIND_PARAMS):
+            for instance in self.model.query.filter(self._column.in_(ids[i:i + MAX_BIND_PARAMS])):
+                self._loaded[getattr(instance, self._key)] = instance
+
+
 class _Model(object):
     @declared_attr
     def __tablename__(cls):
@@ -134,6 +1195,11 @@ class _Model(object):
         self.session.add(self)
         return self
 
+    @classmethod
+    def loader(cls):
+        """Return the ModelLoader of this model for the current transaction. See :class:`ModelLoader`."""
+        return cls.query.session.loader(cls)
+
     @property
     def query_self(self):
         """Return a query constrained to the current object."""
@@ -141,13 +1207,45 @@ class _Model(object):
 
     @classmethod
     def get_or_create(cls, defaults={}, **kwargs):
+        """Get the row matching kwargs, or create it with kwargs and defaults.
+
+        On PostgreSQL and SQLite the row is created with INSERT ... ON CONFLICT
+        DO NOTHING, directly into the table, so a concurrent insert of the same
+        row is not an error. This bypasses the model's constructor. The
+        instance is loaded from the inserted row with RETURNING (SQLite >=
+        3.35), or with a SELECT if another transaction inserted it first. Other
+        databases, or kwargs and defaults that are not all column attributes
+        (eg. relationships), create the instance and add it in a savepoint.
+
+        :returns: A tuple of (instance, created).
+        """
+        session = cls.query.session
+        params = dict(kwargs)
+        params.update(defaults)
+        columns = _column_values(cls, params)
+        if columns is not None and _supports_on_conflict(session.bind.dialect):
+            query = cls.query.filter_by(**kwargs)
+            instance = query.first()
+            if instance:
+                return instance, False
+            returning = _supports_returning(session.bind.dialect)
+            result = session.execute(_InsertOnConflict(cls.__table__, columns, returning=returning))
+            if not returning:
+                return query.one(), result.rowcount == 1
+            # SQLite returns no result at all, rather than no rows, when nothing is inserted.
+            instances = list(cls.query.instances(result)) if result.returns_rows else []
+            result.close()
+            if instances:
+                return instances[0], True
+            return query.one(), False
+
         with cls.query.session:
             query = cls.query.filter_by(**kwargs)
             instance = query.first()
             if instance:
                 return instance, False
             else:
-                with cls.query.session as session:
+                with cls.query.session.savepoint() as session:
                     try:
                         params = dict((k, v) for k, v in kwargs.iteritems() if not isinstance(v, ClauseElement))
                         params.update(defaults)
@@ -159,6 +1257,121 @@ class _Model(object):
                         instance = query.one()
                         return instance, False
 
+    @classmethod
+    def upsert(cls, values={}, **kwargs):
+        """Create or update the row matching kwargs, setting values on it.
+
+        The columns in kwargs must have a unique constraint. On PostgreSQL and
+        SQLite this is a single INSERT ... ON CONFLICT DO UPDATE. Other
+        databases, or kwargs and values that are not all column attributes,
+        use get_or_create() and then update the instance.
+
+        :returns: The instance.
+        """
+        session = cls.query.session
+        conflict_columns = _column_values(cls, kwargs)
+        update = _column_values(cls, values)
+        if conflict_columns is None or update is None or not _supports_on_conflict(session.bind.dialect):
+            instance, created = cls.get_or_create(defaults=values, **kwargs)
+            for name, value in values.iteritems():
+                setattr(instance, name, value)
+            return instance
+        params = dict(conflict_columns)
+        params.update(update)
+        session.execute(_InsertOnConflict(cls.__table__, params, conflict_columns=sorted(conflict_columns),
+                                          update=sorted(update)))
+        # Refresh the instance if it is already in the session.
+        return cls.query.filter_by(**kwargs).populate_existing().one()
+
+    @classmethod
+    def bulk_get_or_create(cls, list_of_kwargs, defaults={}):
+        """Like get_or_create(), but for many rows in a constant number of statements.
+
+        Each element of list_of_kwargs must have the same keys. Existing rows
+        are found with one SELECT and missing rows inserted with one INSERT
+        (each split to stay within MAX_BIND_PARAMS). The inserted rows are then
+        loaded with another SELECT. Rows are inserted directly into the table,
+        so Python-side model constructors are not called, and keys must be
+        column attributes (not relationships).
+
+        If a concurrent transaction inserts some of the same rows, the INSERT
+        is rolled back to a savepoint and retried for the rows still missing.
+
+        :returns: A list of (instance, created) pairs in the order of list_of_kwargs.
+        """
+        list_of_kwargs = list(list_of_kwargs)
+        if not list_of_kwargs:
+            return []
+        names = sorted(list_of_kwargs[0])
+        keys = [tuple(kwargs[name] for name in names) for kwargs in list_of_kwargs]
+        unique_keys = list(OrderedDict.fromkeys(keys))
+        with cls.query.session as session:
+            found = cls._bulk_find(names, unique_keys)
+            missing = [key for key in unique_keys if key not in found]
+            created = set()
+            while missing:
+                try:
+                    with session.savepoint():
+                        cls._bulk_insert(session, names, missing, defaults)
+                except IntegrityError:
+                    # Rows were inserted concurrently. Find them, then retry the remainder.
+                    inserted = cls._bulk_find(names, missing)
+                    if not inserted:
+                        raise
+                else:
+                    inserted = cls._bulk_find(names, missing)
+                    if len(inserted) < len(missing):
+                        raise InvalidRequestError('Inserted %s rows could not be found by %s'
+                                                  % (cls.__name__, ', '.join(names)))
+                    created.update(inserted)
+                found.update(inserted)
+                missing = [key for key in missing if key not in found]
+
+        result = []
+        for key in keys:
+            result.append((found[key], key in created))
+            # Only the first occurrence of a key was created.
+            created.discard(key)
+        return result
+
+    @classmethod
+    def _bulk_find(cls, names, keys):
+        """Return a dict mapping each key (a tuple of values for names) that exists to its instance."""
+        columns = [getattr(cls, name) for name in names]
+        found = {}
+        chunk_size = max(1, MAX_BIND_PARAMS // len(names))
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            if len(names) == 1 and all(key[0] is not None for key in chunk):
+                criterion = columns[0].in_([key[0] for key in chunk])
+            else:
+                criterion = or_(*[and_(*[column == value for column, value in zip(columns, key)]) for key in chunk])
+            for instance in cls.query.filter(criterion):
+                found[tuple(getattr(instance, name) for name in names)] = instance
+        return found
+
+    @classmethod
+    def _bulk_insert(cls, session, names, keys, defaults):
+        rows = []
+        for key in keys:
+            row = dict(defaults)
+            row.update(zip(names, key))
+            columns = _column_values(cls, row)
+            if columns is None:
+                raise InvalidRequestError('bulk_get_or_create() only supports column attributes of %s, not %s'
+                                          % (cls.__name__, ', '.join(sorted(row))))
+            rows.append(columns)
+        table = cls.__table__
+        dialect = session.bind.dialect
+        # A multiple-VALUES INSERT can not evaluate Python-side column defaults for each row.
+        if dialect.supports_multivalues_insert and \
+                not any(column.default is not None for column in table.columns if column.key not in rows[0]):
+            chunk_size = max(1, MAX_BIND_PARAMS // len(rows[0]))
+            for i in range(0, len(rows), chunk_size):
+                session.execute(table.insert(inline=True).values(rows[i:i + chunk_size]))
+        else:
+            session.execute(table.insert(), rows)
+
     def __repr__(self):
         def reprs(cls):
             attrs = {}
@@ -188,39 +1401,214 @@ class _Model(object):
 
 Model = declarative_base(cls=_Model)
 
+# The fingerprint of the schema last created by DatabaseModule, for each --database_schema_name.
+schema_fingerprints = Table('waffle_schema', MetaData(), Column('name', String(255), primary_key=True),
+                            Column('fingerprint', String(40), nullable=False))
+
+
+def _discard_schema_fingerprints(metadata, connection, **kw):
+    """Discard the stored fingerprints when the tables of Model.metadata are dropped."""
+    if connection.dialect.has_table(connection, schema_fingerprints.name):
+        connection.execute(schema_fingerprints.delete())
+
+
+event.listen(Model.metadata, 'after_drop', _discard_schema_fingerprints)
+
+
+def schema_fingerprint(metadata):
+    """Return a hash of the tables, columns, indexes and constraints in metadata."""
+    description = []
+    for table in sorted(metadata.tables.values(), key=lambda table: table.key):
+        items = []
+        for column in table.columns:
+            items.append(('column', column.name, repr(column.type), column.nullable, column.primary_key))
+        for index in table.indexes:
+            items.append(('index', index.name, index.unique, [column.name for column in index.columns]))
+        for constraint in table.constraints:
+            columns = [getattr(column, 'name', column) for column in getattr(constraint, 'columns', [])]
+            items.append(('constraint', type(constraint).__name__, constraint.name, sorted(columns)))
+        description.append((table.key, sorted(items)))
+    return hashlib.sha1(repr(description)).hexdigest()
+
 
 class DatabaseModule(Module):
     """Configure and initialize the ORM.
 
     - Requires the FlagsModule.
-    - Uses the --database_uri flag.
+    - Uses the --database_uri and --database_replica_uris flags.
     - Provides DatabaseSession, a thread safe factory for SQLAlchemy sessions.
     """
 
     database_uri = Flag('--database_uri', help='Database URI.', metavar='URI', required=True)
-    database_pool_size = Flag('--database_pool_size', help='Database connection pool size.', metavar='N', default=5)
+    database_pool_size = Flag('--database_pool_size', help='Database connection pool size.', metavar='N', type=int,
+                              default=5)
+    database_max_overflow = Flag('--database_max_overflow', metavar='N', type=int, default=10,
+                                 help='Connections to open beyond --database_pool_size when all are in use.')
+    database_pool_timeout = Flag('--database_pool_timeout', metavar='SECONDS', type=float, default=30,
+                                 help='Time to wait for a pooled connection before failing.')
+    database_pool_recycle = Flag('--database_pool_recycle', metavar='SECONDS', type=int, default=-1,
+                                 help='Replace pooled connections older than this. -1 to never replace them.')
+    database_pool_pre_ping = Flag('--database_pool_pre_ping', action='store_true',
+                                  help='Test pooled connections when checking them out, replacing those that '
+                                  'have been disconnected.')
+    database_query_cache = Flag('--database_query_cache', choices=['lru', 'redis'], default='lru',
+                                help='Where Query.cached() stores results. "redis" requires the RedisModule.')
+    database_query_cache_size = Flag('--database_query_cache_size', metavar='N', type=int, default=10000,
+                                     help='Maximum number of results in the "lru" query cache.')
+    database_slow_query_ms = Flag('--database_slow_query_ms', metavar='MS', type=float, default=0,
+                                  help='Log statements taking at least this long. 0 to disable.')
+    database_repeated_query_threshold = Flag('--database_repeated_query_threshold', metavar='N', type=int,
+                                             default=0, help='Log statements executed more than N times in one '
+                                             'request or transaction, which are likely N+1 queries. 0 to disable.')
+    database_query_stats = Flag('--database_query_stats', action='store_true',
+                                help='Record QueryStats for each request and outermost transaction. They are also '
+                                'recorded if --database_repeated_query_threshold is set.')
+    database_ddl = Flag('--database_ddl', choices=['auto', 'always', 'off'], default='auto',
+                        help='Create missing tables at startup: "auto" only if the schema has changed since it was '
+                        'last created, "always" or "off".')
+    database_schema_name = Flag('--database_schema_name', metavar='NAME', default='default',
+                                help='Name to store the schema fingerprint of --database_ddl=auto under. '
+                                'Applications with different models sharing a database need different names.')
+    database_session_scope = Flag('--database_session_scope', choices=sorted(SESSION_SCOPES), default='thread',
+                                  help='Scope of sessions: a thread, or a greenlet (requires gevent).')
+    database_cooperative = Flag('--database_cooperative', action='store_true',
+                                help='Make database I/O yield to other greenlets, with a session per greenlet '
+                                'unless --database_session_scope is given.')
+    database_join_nested = Flag('--database_join_nested', action='store_true',
+                                help='Nested "with session:" blocks join the enclosing transaction, rather than '
+                                'creating a savepoint.')
+    database_pool_class = Flag('--database_pool_class', choices=['default'] + sorted(POOL_CLASSES),
+                               default='default', help='Connection pool implementation.')
+    database_replica_uris = Flag('--database_replica_uris', metavar='URI,...', default='',
+                                 help='Comma-separated read replica URIs, used by read-only transactions.')
+    database_replica_strategy = Flag('--database_replica_strategy', choices=REPLICA_STRATEGIES,
+                                     default='round_robin', help='How to choose a replica for each read-only '
+                                     'transaction.')
 
     def configure(self, binder):
         binder.bind(DatabaseCreated, to=[], scope=singleton)
 
+    @property
+    def session_scope(self):
+        if self.database_cooperative and self.database_session_scope == 'thread':
+            return 'greenlet'
+        return self.database_session_scope
+
+    def _create_engine(self, uri, instrumentation, stats=None):
+        if self.database_cooperative:
+            make_driver_cooperative(make_url(uri).get_dialect())
+        if self.database_pool_class == 'default':
+            url = make_url(uri)
+            poolclass = url.get_dialect().get_pool_class(url)
+        else:
+            poolclass = POOL_CLASSES[self.database_pool_class]
+        extra_args = {'pool_recycle': self.database_pool_recycle}
+        if issubclass(poolclass, pool.QueuePool):
+            extra_args.update(pool_size=self.database_pool_size, max_overflow=self.database_max_overflow,
+                              pool_timeout=self.database_pool_timeout)
+        if stats is not None:
+            poolclass = stats.pool_class(poolclass)
+        engine = create_engine(uri, convert_unicode=True, poolclass=poolclass, **extra_args)
+        if self.database_pool_pre_ping:
+            event.listen(engine, 'checkout', _ping_connection)
+        if stats is not None:
+            stats.attach(engine)
+        instrumentation.attach(engine)
+        return engine
+
+    @provides(QueryInstrumentation, scope=singleton)
+    def provide_query_instrumentation(self):
+        return QueryInstrumentation(self.database_slow_query_ms, self.database_repeated_query_threshold,
+                                    self.session_scope, self.database_query_stats)
+
+    @provides(DatabasePoolStats, scope=singleton)
+    def provide_db_pool_stats(self):
+        return DatabasePoolStats()
+
     @provides(DatabaseEngine, scope=singleton)
-    def provide_db_engine(self):
+    @inject(stats=DatabasePoolStats, instrumentation=QueryInstrumentation)
+    def provide_db_engine(self, stats, instrumentation):
         logger.info('Connecting to %s', self.database_uri)
-        extra_args = {}
-        if not self.database_uri.startswith('sqlite:'):
-            extra_args['pool_size'] = self.database_pool_size
-        engine = create_engine(self.database_uri, convert_unicode=True, **extra_args)
-        return engine
+        return self._create_engine(self.database_uri, instrumentation, stats)
+
+    @provides(DatabaseReplicas, scope=singleton)
+    @inject(instrumentation=QueryInstrumentation)
+    def provide_db_replicas(self, instrumentation):
+        uris = [uri.strip() for uri in self.database_replica_uris.split(',') if uri.strip()]
+        for uri in uris:
+            logger.info('Connecting to replica %s', uri)
+        return DatabaseReplicas([self._create_engine(uri, instrumentation) for uri in uris],
+                                self.database_replica_strategy)
+
+    @provides(BeforeFork)
+    def provide_before_fork(self):
+        return [self.dispose_engine]
+
+    @inject(engine=DatabaseEngine, replicas=DatabaseReplicas)
+    def dispose_engine(self, engine, replicas):
+        """Close pooled connections so that they are not shared with forked processes."""
+        engine.dispose()
+        replicas.dispose()
+
+    @provides(QueryCache, scope=singleton)
+    @inject(injector=Injector)
+    def provide_query_cache(self, injector):
+        if self.database_query_cache == 'redis':
+            from redis import Redis
+            return RedisQueryCache(injector.get(Redis))
+        return LRUQueryCache(self.database_query_cache_size)
 
     @provides(DatabaseSession, scope=singleton)
-    @inject(engine=DatabaseEngine)
-    def provide_db_session(self, engine):
-        factory = sessionmaker(autocommit=True, autoflush=True, bind=engine, query_cls=Query, class_=ExplicitSession)
-        session = ExplicitSessionManager(factory)
+    @inject(engine=DatabaseEngine, replicas=DatabaseReplicas, query_cache=QueryCache,
+            instrumentation=QueryInstrumentation)
+    def provide_db_session(self, engine, replicas, query_cache, instrumentation):
+        factory = sessionmaker(autocommit=True, autoflush=True, bind=engine, query_cls=Query, class_=ExplicitSession,
+                               replicas=replicas, query_cache=query_cache, instrumentation=instrumentation,
+                               join_nested=self.database_join_nested)
+        session = ExplicitSessionManager(factory, self.session_scope)
         Model.query = session.query_property()
-        Model.metadata.create_all(bind=engine)
+        self.create_schema(engine)
         return session
 
+    def create_schema(self, engine):
+        """Create missing tables, according to --database_ddl.
+
+        In "auto" mode a fingerprint of Model.metadata is stored in the
+        waffle_schema table under --database_schema_name, and tables are only
+        created if it does not match.
+        """
+        if self.database_ddl == 'off':
+            return
+        if self.database_ddl == 'always':
+            Model.metadata.create_all(bind=engine)
+            return
+        fingerprint = schema_fingerprint(Model.metadata)
+        name = self.database_schema_name
+        connection = engine.connect()
+        try:
+            if engine.dialect.has_table(connection, schema_fingerprints.name):
+                stored = select([schema_fingerprints.c.fingerprint]).where(schema_fingerprints.c.name == name)
+                if connection.execute(stored).scalar() == fingerprint:
+                    return
+            logger.info('Schema fingerprint changed, creating missing tables')
+            Model.metadata.create_all(bind=connection)
+            schema_fingerprints.create(bind=connection, checkfirst=True)
+            with connection.begin():
+                connection.execute(schema_fingerprints.delete().where(schema_fingerprints.c.name == name))
+                connection.execute(schema_fingerprints.insert(), name=name, fingerprint=fingerprint)
+        finally:
+            connection.close()
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Replace connections that fail a trivial query when checked out."""
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception as e:
+        raise DisconnectionError(str(e))
+
 
 def session_from(thing):
     """Get session from an object."""
@@ -237,7 +1625,7 @@ def session_from(thing):
     return None
 
 
-def transaction(thing):
+def transaction(thing=None, readonly=False, join=None):
     """A general-purpose transaction helper.
 
     Can be used with a session-like object (although this is redundant):
@@ -258,10 +1646,26 @@ def transaction(thing):
         @transaction
         def method(self, ...):
             ...
+
+    Pass readonly=True for a read-only transaction, which may use a read
+    replica (see :meth:`ExplicitSessionManager.readonly`):
+
+        @transaction(readonly=True)
+        def method(self, ...):
+            ...
+
+    Pass join=True for a method that joins an enclosing transaction rather
+    than creating a savepoint (see :meth:`ExplicitSessionManager.join`), or
+    join=False for a savepoint even if --database_join_nested is set. Raw
+    functions (eg. endpoints) always run in an outermost transaction, so
+    join can not be given for them.
     """
+    if thing is None:
+        return lambda thing: transaction(thing, readonly=readonly, join=join)
+
     session = session_from(thing)
     if session is not None:
-        return session
+        return _Transaction(session, readonly=readonly, join=join)
 
     argspec = inspect.getargspec(thing)
 
@@ -269,11 +1673,14 @@ def transaction(thing):
     if argspec.args and argspec.args[0] in ('self', 'cls'):
         @wraps(thing)
         def wrapper(self, *args, **kwargs):
-            with session_from(self):
+            with _Transaction(session_from(self), readonly=readonly, join=join):
                 return thing(self, *args, **kwargs)
 
         return wrapper
 
     # Raw function
+    if join is not None:
+        raise ValueError('join can not be used with %s, which runs in an outermost transaction' % thing.__name__)
     thing.__transaction__ = True
+    thing.__transaction_readonly__ = readonly
     return thing
@@ -1,9 +1,25 @@
+import socket
 import threading
 
 import pytest
-from sqlalchemy.exc import InvalidRequestError
+from injector import Injector
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, String, Table, create_engine, event, pool
+from sqlalchemy.exc import InvalidRequestError, TimeoutError
+from sqlalchemy.orm import relationship
 
+from waffle import conftest
 from waffle.conftest import User
+from waffle.db import DatabaseEngine, DatabaseModule, DatabasePoolStats, DatabaseReplicas, \
+    DatabaseSession, LRUQueryCache, Model, Query, QueryCache, QueryInstrumentation, _FETCH_ROWS_INTERNALS, \
+    _gevent_wait_callback, _statement_shape, make_driver_cooperative, schema_fingerprint, transaction
+from waffle.flags import FlagsModule
+
+
+class Pet(Model):
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    label = Column('pet_label', String(20), unique=True)
+    owner_id = Column(Integer, ForeignKey('User.id'))
+    owner = relationship(User)
 
 
 @pytest.mark.usefixtures('db')
@@ -108,3 +124,665 @@ class TestDatabaseSessionManager(object):
             assert not b_created
 
         assert a.id == b.id
+
+    def test_get_or_create_loads_inserted_row_with_returning(self):
+        with self.session as session:
+            bob, created = User.get_or_create(name='bob')
+            assert created
+            assert bob in session
+            assert (bob.id, bob.name) == (1, 'bob')
+            shapes = session.query_stats.shapes
+        # The instance is loaded from the INSERT, rather than a second SELECT.
+        assert [shape.split()[0] for shape in shapes.elements()].count('SELECT') == 1
+
+    def test_stream(self):
+        with self.session:
+            for name in ('bob', 'fred', 'jim'):
+                User(name=name).save()
+
+        with self.session:
+            query = User.query.order_by(User.id)
+            assert [u.name for u in query.stream(batch_size=2)] == ['bob', 'fred', 'jim']
+            query = self.session.query(User.name).order_by(User.id)
+            assert list(query.stream_flatten(batch_size=2)) == ['bob', 'fred', 'jim']
+            query = self.session.query(User.name, User.id).order_by(User.id)
+            assert list(query.stream_column(0, batch_size=2)) == ['bob', 'fred', 'jim']
+
+    def test_bulk_get_or_create(self):
+        with self.session:
+            bob, _ = User.get_or_create(name='bob')
+
+        with self.session:
+            result = User.bulk_get_or_create([{'name': 'fred'}, {'name': 'bob'}, {'name': 'fred'}, {'name': 'jim'}])
+            assert [(u.name, created) for u, created in result] == \
+                [('fred', True), ('bob', False), ('fred', False), ('jim', True)]
+            assert result[1][0].id == bob.id
+            assert result[0][0] is result[2][0]
+            assert User.query.count() == 3
+
+    def test_bulk_get_or_create_with_multiple_columns(self):
+        with self.session:
+            result = User.bulk_get_or_create([{'name': 'bob', 'id': 10}, {'name': None, 'id': 11}])
+            assert [(u.id, u.name, created) for u, created in result] == [(10, 'bob', True), (11, None, True)]
+
+        with self.session:
+            result = User.bulk_get_or_create([{'name': None, 'id': 11}, {'name': 'bob', 'id': 10}])
+            assert [(u.id, created) for u, created in result] == [(11, False), (10, False)]
+
+    def test_bulk_get_or_create_with_renamed_column(self):
+        with self.session:
+            rex, _ = Pet.get_or_create(label='rex')
+            result = Pet.bulk_get_or_create([{'label': 'rex'}, {'label': 'max'}])
+            assert [(pet.label, created) for pet, created in result] == [('rex', False), ('max', True)]
+            assert result[0][0] is rex
+
+    def test_bulk_get_or_create_retries_rows_inserted_concurrently(self, monkeypatch):
+        find = User._bulk_find.im_func
+        calls = []
+
+        def concurrent_find(cls, names, keys):
+            found = find(cls, names, keys)
+            if not calls:
+                # Another transaction inserts one of the missing rows.
+                calls.append(keys)
+                with self.session:
+                    User(id=20, name='fred').save()
+                    self.session.flush()
+                    self.session.expunge_all()
+            return found
+
+        monkeypatch.setattr(User, '_bulk_find', classmethod(concurrent_find))
+        with self.session:
+            result = User.bulk_get_or_create([{'id': 20, 'name': 'fred'}, {'id': 21, 'name': 'jim'}])
+            assert [(u.name, created) for u, created in result] == [('fred', False), ('jim', True)]
+            assert User.query.count() == 2
+
+    def test_upsert(self):
+        with self.session:
+            bob = User.upsert({'name': 'bob'}, id=1)
+            assert (bob.id, bob.name) == (1, 'bob')
+
+        with self.session:
+            fred = User.upsert({'name': 'fred'}, id=1)
+            assert fred is bob
+            assert bob.name == 'fred'
+            assert User.query.count() == 1
+
+    def test_get_or_create_and_upsert_renamed_column(self):
+        with self.session:
+            rex, created = Pet.get_or_create(label='rex')
+            assert created
+            assert Pet.get_or_create(label='rex') == (rex, False)
+            assert Pet.upsert({'owner_id': None}, label='rex') is rex
+            assert Pet.upsert({'label': 'max'}, id=rex.id).label == 'max'
+
+    def test_get_or_create_and_upsert_relationship(self):
+        with self.session as session:
+            bob = User(name='bob').save()
+            rex, created = Pet.get_or_create(owner=bob, defaults={'label': 'rex'})
+            assert created
+            assert rex in session
+            assert Pet.get_or_create(owner=bob) == (rex, False)
+            assert Pet.upsert({'owner': bob}, label='max').owner is bob
+
+    def test_get_or_create_skips_rows_inserted_concurrently(self, monkeypatch):
+        def first(query):
+            # Another transaction inserts the row after get_or_create() looks for it.
+            monkeypatch.undo()
+            User(id=5, name='bob').save()
+            self.session.flush()
+            return None
+
+        with self.session:
+            monkeypatch.setattr(Query, 'first', first)
+            bob, created = User.get_or_create(id=5)
+            assert not created
+            assert bob.name == 'bob'
+
+    def test_transactions_begin_on_first_statement(self):
+        stats = self.injector.get(DatabasePoolStats)
+        checkouts = stats.checkouts
+        with self.session as session:
+            with session:
+                pass
+        assert stats.checkouts == checkouts
+
+        with self.session as session:
+            User.query.count()
+            with session:
+                pass
+            assert not [shape for shape in session.query_stats.shapes if 'SAVEPOINT' in shape]
+        assert stats.checkouts == checkouts + 1
+
+    def test_joined_blocks_do_not_create_savepoints(self):
+        with self.session as session:
+            User(name='bob').save()
+            with session.join():
+                User(name='fred').save()
+                session.flush()
+                assert session._depth == 2
+            assert session._depth == 1
+            stats = session.query_stats
+        assert stats.savepoints == 0
+        assert not [shape for shape in stats.shapes if 'SAVEPOINT' in shape]
+        with self.session:
+            assert User.query.count() == 2
+
+    def test_exception_in_joined_block_rolls_back_transaction(self):
+        with pytest.raises(ValueError):
+            with self.session as session:
+                User(name='bob').save()
+                with session.join():
+                    User(name='fred').save()
+                    raise ValueError
+        assert not self.session._registry()._depth
+        with self.session:
+            assert User.query.count() == 0
+
+    def test_savepoints_are_counted_by_site(self):
+        with self.session as session:
+            for name in ('bob', 'fred'):
+                with session:
+                    User(name=name).save()
+                    session.flush()
+            stats = session.query_stats
+        assert stats.savepoints == 2
+        [(site, count)] = stats.savepoint_sites.items()
+        assert count == 2
+        assert site.startswith(__file__.rstrip('c')) and site.endswith('test_savepoints_are_counted_by_site')
+
+    def test_inserts_that_may_be_retried_use_savepoints_when_nested_blocks_join(self):
+        self.session.configure(join_nested=True)
+        with self.session as session:
+            with session:
+                User(name='bob').save()
+                session.flush()
+            assert session.query_stats.savepoints == 0
+            User.bulk_get_or_create([{'name': 'fred'}])
+            assert session.query_stats.savepoints == 1
+
+    def test_join_is_rejected_for_raw_functions(self):
+        with pytest.raises(ValueError):
+            @transaction(join=True)
+            def endpoint():
+                pass
+
+    def test_readonly_transaction_expunges_loaded_instances(self):
+        with self.session as session:
+            bob = User(name='bob')
+            bob.save()
+            User(name='fred').save()
+        session.expunge(session.query(User).filter_by(name='fred').one())
+
+        with self.session.readonly:
+            assert session.autoflush is False
+            assert User.query.filter_by(name='bob').one() is bob
+            fred = User.query.filter_by(name='fred').one()
+        assert session.autoflush is True
+        # Instances already in the session stay there.
+        assert bob in session
+        assert fred not in session
+        assert fred.name == 'fred'
+
+    def test_readonly_transaction_can_not_change_instances(self):
+        with pytest.raises(InvalidRequestError):
+            with self.session.readonly:
+                User(name='bob').save()
+        with pytest.raises(InvalidRequestError):
+            with self.session.readonly as session:
+                session.execute(User.__table__.insert().values(name='bob'))
+        assert not self.session._registry()._readonly
+        with self.session:
+            assert User.query.count() == 0
+
+    def test_loader_batches_lookups(self):
+        with self.session as session:
+            users = [User(name=name).save() for name in ('bob', 'fred', 'jim')]
+            session.flush()
+            ids = [u.id for u in users]
+        with self.session as session:
+            loader = User.loader()
+            assert User.loader() is loader
+            pending = [loader.load(id) for id in ids + [1000]]
+
+            def selects():
+                return sum(n for shape, n in session.query_stats.shapes.items() if shape.startswith('SELECT'))
+            users = [p.get() for p in pending]
+            assert [u.name for u in users[:3]] == ['bob', 'fred', 'jim']
+            assert users[3] is None
+            assert selects() == 1
+            assert all(u in session for u in users[:3])
+            # Results are remembered for the rest of the transaction.
+            assert loader.load_many(reversed(ids)) == users[2::-1]
+            assert selects() == 1
+        with self.session:
+            assert User.loader() is not loader
+
+    def test_rows_and_tuples(self):
+        with self.session as session:
+            User(name='bob').save()
+            User(name='fred').save()
+            session.flush()
+            query = User.query.order_by(User.name)
+            bob, fred = query.all()
+            session.expunge_all()
+
+            rows = query.rows()
+            assert [(row.id, row.name) for row in rows] == [(bob.id, 'bob'), (fred.id, 'fred')]
+            assert rows[0]._asdict() == {'id': bob.id, 'name': 'bob'}
+            assert query.tuples() == [tuple(row) for row in rows]
+            assert not session.identity_map
+
+            rows = session.query(User.name, User).order_by(User.name).rows()
+            assert rows[1].name == 'fred'
+            assert rows[1].User.id == fred.id
+            assert session.query(User.name).filter_by(name='bob').tuples() == [('bob',)]
+
+    def test_rows_without_sqlalchemy_internals(self, monkeypatch):
+        with self.session as session:
+            bob = User(name='bob').save()
+            session.flush()
+            query = session.query(User.name, User)
+            rows, tuples = query.rows(), query.tuples()
+            monkeypatch.setattr('waffle.db._FETCH_ROWS_INTERNALS', _FETCH_ROWS_INTERNALS + ('_missing',))
+            assert query.rows() == rows
+            assert query.tuples() == tuples
+            assert tuples == [('bob', (bob.id, 'bob'))]
+
+    def test_cached_query(self):
+        cache = self.injector.get(QueryCache)
+        with self.session:
+            User(name='bob').save()
+
+        for _ in range(2):
+            with self.session:
+                assert [u.name for u in User.query.cached(ttl=60)] == ['bob']
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Changes made outside a session are not seen until the entry is invalidated.
+        self.injector.get(DatabaseEngine).execute(User.__table__.update().values(name='fred'))
+        with self.session:
+            bob = User.query.cached(ttl=60).one()
+            assert bob.name == 'bob'
+            User(name='jim').save()
+
+        with self.session:
+            assert sorted(u.name for u in User.query.cached(ttl=60)) == ['fred', 'jim']
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    def test_cached_query_is_not_used_after_writing_to_its_tables(self):
+        cache = self.injector.get(QueryCache)
+        with self.session:
+            assert User.query.cached(key='users').count() == 0
+            User(name='bob').save()
+            assert User.query.cached(key='users').count() == 1
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    def test_cached_query_key_is_a_namespace(self):
+        with self.session:
+            User(name='bob').save()
+        for _ in range(2):
+            with self.session:
+                assert User.query.cached(key='users').count() == 1
+                assert [u.name for u in User.query.cached(key='users')] == ['bob']
+                assert User.query.with_entities(User.name).cached(key='users').all() == [('bob',)]
+
+    def test_cached_query_is_invalidated_after_nested_rollback(self):
+        with self.session:
+            assert User.query.cached().all() == []
+        with self.session as session:
+            User(name='new').save()
+            session.flush()
+            with pytest.raises(ValueError):
+                with session:
+                    User.query.count()
+                    raise ValueError
+        with self.session:
+            assert [u.name for u in User.query.cached()] == ['new']
+
+    def test_cached_query_ignores_released_savepoints(self):
+        with pytest.raises(ValueError):
+            with self.session as session:
+                with session.savepoint():
+                    User(name='ghost').save()
+                assert [u.name for u in User.query.cached()] == ['ghost']
+                raise ValueError
+        with self.session:
+            assert User.query.count() == 0
+            assert User.query.cached().all() == []
+
+    def test_query_stats(self):
+        with self.session as session:
+            User(name='bob').save()
+            with session:
+                User.query.filter_by(name='bob').one()
+                stats = session.query_stats
+        assert stats.count >= 2
+        assert stats.slowest == sorted(stats.slowest, reverse=True)
+        assert set(['INSERT', 'SELECT']) <= set(shape.split()[0] for shape in stats.shapes)
+        assert session.query_stats is None
+
+    def test_repeated_and_slow_queries_are_logged(self, caplog):
+        instrumentation = self.injector.get(QueryInstrumentation)
+        instrumentation.repeated_query_threshold = 2
+        instrumentation.slow_query_ms = 1e-6
+        with self.session:
+            for i in range(3):
+                User.query.filter_by(id=i).first()
+        messages = [record.getMessage() for record in caplog.records if record.name == 'waffle.db']
+        assert len([m for m in messages if m.startswith('Slow query')]) >= 3
+        repeated = [m for m in messages if 'N+1' in m]
+        assert len(repeated) == 1
+        assert repeated[0].startswith('Statement executed 3 times, possibly an N+1 query: SELECT')
+
+
+class SQLiteTestingModule(conftest.TestingModule):
+    """Flags for a database in the directory root."""
+
+    def __init__(self, root, **flags):
+        flags.setdefault('database_uri', 'sqlite:///%s/primary.db' % root)
+        super(SQLiteTestingModule, self).__init__(**flags)
+
+
+class TestReadReplicas(object):
+    @pytest.fixture(autouse=True)
+    def replicated_db(self, request, tmpdir):
+        replica_uris = 'sqlite:///%s/replica1.db,sqlite:///%s/replica2.db' % (tmpdir, tmpdir)
+        injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir), database_replica_uris=replica_uris)])
+        engine = injector.get(DatabaseEngine)
+
+        # pysqlite does not emit BEGIN itself, which SAVEPOINT requires.
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute('BEGIN')
+
+        self.session = injector.get(DatabaseSession)
+        self.replicas = injector.get(DatabaseReplicas)
+        for engine in self.replicas.engines:
+            # Replication would normally create the schema and rows.
+            Model.metadata.create_all(bind=engine)
+            engine.execute(User.__table__.insert(), name=engine.url.database)
+
+        @request.addfinalizer
+        def finalize_session():
+            self.session.remove()
+            engine.dispose()
+            self.replicas.dispose()
+
+    def test_readonly_transactions_use_replicas_in_turn(self):
+        names = []
+        for _ in range(3):
+            with self.session.readonly:
+                names.append(User.query.one().name)
+        assert [name.rsplit('/', 1)[1] for name in names] == ['replica1.db', 'replica2.db', 'replica1.db']
+
+    def test_replica_is_chosen_by_first_statement(self):
+        with self.session.readonly:
+            assert self.replicas.in_use() == [(engine, 0) for engine in self.replicas.engines]
+        with self.session.readonly:
+            assert User.query.one().name.endswith('replica1.db')
+
+    def test_writes_use_primary(self):
+        with self.session:
+            User(name='bob').save()
+
+        with self.session:
+            assert [u.name for u in User.query] == ['bob']
+
+    def test_readonly_transaction_nested_in_write_uses_primary(self):
+        with self.session:
+            User(name='bob').save()
+            with self.session.readonly:
+                assert [u.name for u in User.query] == ['bob']
+        assert self.replicas.in_use() == [(engine, 0) for engine in self.replicas.engines]
+
+    def test_readonly_transaction_decorator(self):
+        class Reader(object):
+            _session = self.session
+
+            @transaction(readonly=True)
+            def count(self):
+                return User.query.filter(User.name.like('%replica%')).count()
+
+        assert Reader().count() == 1
+
+
+class TestConnectionPool(object):
+    def create_engine(self, tmpdir, **flags):
+        injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir), **flags)])
+        return injector.get(DatabaseEngine), injector.get(DatabasePoolStats)
+
+    def test_pool_flags(self, tmpdir):
+        engine, _ = self.create_engine(tmpdir, database_pool_class='queue', database_pool_size=2,
+                                       database_max_overflow=3, database_pool_timeout=5, database_pool_recycle=60)
+        assert isinstance(engine.pool, pool.QueuePool)
+        assert (engine.pool.size(), engine.pool._max_overflow, engine.pool._timeout, engine.pool._recycle) == \
+            (2, 3, 5, 60)
+
+    def test_pool_flags_are_parsed(self, tmpdir):
+        args = ['test', '--database_uri=sqlite:///%s/primary.db' % tmpdir, '--database_pool_class=queue',
+                '--database_pool_size=2', '--database_max_overflow=3', '--database_pool_timeout=0.5']
+        engine = Injector([FlagsModule(args), DatabaseModule]).get(DatabaseEngine)
+        assert (engine.pool.size(), engine.pool._max_overflow, engine.pool._timeout) == (2, 3, 0.5)
+
+    def test_pool_stats(self, tmpdir):
+        engine, stats = self.create_engine(tmpdir, database_pool_class='queue', database_pool_size=1,
+                                           database_max_overflow=1, database_pool_timeout=0.01)
+        first = engine.connect()
+        second = engine.connect()
+        assert (stats.checked_out, stats.overflow) == (2, 1)
+        with pytest.raises(TimeoutError):
+            engine.connect()
+        second.close()
+        first.close()
+        assert (stats.checked_out, stats.overflow, stats.checkouts, stats.checkout_failures) == (0, 0, 2, 1)
+        assert sum(count for _, count in stats.wait_histogram()) == 3
+
+    def test_pool_pre_ping_replaces_disconnected_connections(self, tmpdir):
+        engine, stats = self.create_engine(tmpdir, database_pool_class='queue', database_pool_size=1,
+                                           database_pool_pre_ping=True)
+        connection = engine.connect()
+        dbapi_connection = connection.connection.connection
+        connection.close()
+        dbapi_connection.close()
+        assert engine.execute('SELECT 1').scalar() == 1
+        assert stats.checkout_failures == 0
+
+
+class TestSchemaCreation(object):
+    def create_engine(self, tmpdir, ddl, **kwargs):
+        injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir), database_ddl=ddl, **kwargs)])
+        injector.get(DatabaseSession)
+        return injector.get(DatabaseEngine)
+
+    def test_create_all_is_skipped_when_schema_is_unchanged(self, tmpdir):
+        engine = self.create_engine(tmpdir, 'auto')
+        assert engine.has_table('User')
+        engine.execute('DROP TABLE "User"')
+        engine.dispose()
+
+        engine = self.create_engine(tmpdir, 'auto')
+        assert not engine.has_table('User')
+        engine.dispose()
+
+        engine = self.create_engine(tmpdir, 'always')
+        assert engine.has_table('User')
+        engine.dispose()
+
+    def test_schema_fingerprints_are_stored_by_name(self, tmpdir):
+        engine = self.create_engine(tmpdir, 'auto', database_schema_name='other')
+        engine.dispose()
+        engine = self.create_engine(tmpdir, 'auto')
+        assert 'waffle_schema' not in Model.metadata.tables
+        assert sorted(name for name, in engine.execute('SELECT name FROM waffle_schema')) == ['default', 'other']
+        engine.dispose()
+
+    def test_dropping_tables_discards_schema_fingerprints(self, tmpdir):
+        engine = self.create_engine(tmpdir, 'auto')
+        Model.metadata.drop_all(bind=engine)
+        assert engine.has_table('waffle_schema')
+        engine.dispose()
+
+        engine = self.create_engine(tmpdir, 'auto')
+        assert engine.has_table('User')
+        engine.dispose()
+
+    def test_ddl_can_be_disabled(self, tmpdir):
+        engine = self.create_engine(tmpdir, 'off')
+        assert engine.table_names() == []
+        engine.dispose()
+
+
+def test_schema_fingerprint():
+    metadata = MetaData()
+    table = Table('t', metadata, Column('id', Integer, primary_key=True), Column('name', String(20)))
+    fingerprint = schema_fingerprint(metadata)
+    assert schema_fingerprint(metadata) == fingerprint
+    Index('t_name', table.c.name)
+    assert schema_fingerprint(metadata) != fingerprint
+
+
+@pytest.mark.parametrize('scope, depths', [('thread', [1, 2]), ('greenlet', [1, 1])])
+def test_session_scope(tmpdir, scope, depths):
+    gevent = pytest.importorskip('gevent')
+    injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir), database_session_scope=scope)])
+    session = injector.get(DatabaseSession)
+    seen = []
+
+    def request():
+        with session as s:
+            seen.append(s._depth)
+            gevent.sleep(0)
+
+    gevent.joinall([gevent.spawn(request), gevent.spawn(request)], raise_error=True)
+    session.remove()
+    injector.get(DatabaseEngine).dispose()
+    assert seen == depths
+
+
+class TestSpawn(object):
+    @pytest.fixture(autouse=True)
+    def greenlet_db(self, request, tmpdir):
+        self.gevent = pytest.importorskip('gevent')
+        injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir), database_cooperative=True)])
+        self.session = injector.get(DatabaseSession)
+
+        @request.addfinalizer
+        def finalize_session():
+            self.session.remove()
+            injector.get(DatabaseEngine).dispose()
+
+    def test_spawned_transactions_run_concurrently_in_their_own_sessions(self):
+        def create(name):
+            self.gevent.sleep(0)
+            user = User(name=name).save()
+            self.session.flush()
+            return user.id, self.session._depth
+
+        @transaction(readonly=True)
+        def count():
+            return User.query.count()
+
+        created = [self.session.spawn(create, name) for name in ('bob', 'fred')]
+        self.gevent.joinall(created, raise_error=True)
+        assert sorted(greenlet.get() for greenlet in created) == [(1, 1), (2, 1)]
+        assert self.session.spawn(count).get() == 2
+
+    def test_spawn_requires_greenlet_sessions(self, tmpdir):
+        injector = Injector([DatabaseModule, SQLiteTestingModule(str(tmpdir.mkdir('thread')))])
+        with pytest.raises(InvalidRequestError):
+            injector.get(DatabaseSession).spawn(lambda: None)
+
+
+def test_gevent_wait_callback_waits_for_the_connection():
+    extensions = pytest.importorskip('psycopg2.extensions')
+    reader, writer = socket.socketpair()
+    states = [extensions.POLL_WRITE, extensions.POLL_READ, extensions.POLL_OK]
+
+    class Connection(object):
+        def poll(self):
+            return states.pop(0)
+
+        def fileno(self):
+            return reader.fileno()
+
+    writer.send(b'x')
+    _gevent_wait_callback(Connection(), timeout=1)
+    assert not states
+
+
+def test_psycopg2_is_made_cooperative():
+    extensions = pytest.importorskip('psycopg2.extensions')
+    from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+    make_driver_cooperative(PGDialect_psycopg2())
+    try:
+        assert extensions.get_wait_callback() is _gevent_wait_callback
+    finally:
+        extensions.set_wait_callback(None)
+
+
+def test_replicas_round_robin():
+    replicas = DatabaseReplicas(['a', 'b', 'c'])
+    chosen = [replicas.acquire() for _ in range(4)]
+    assert chosen == ['a', 'b', 'c', 'a']
+
+
+def test_replicas_least_connections():
+    replicas = DatabaseReplicas(['a', 'b'], strategy='least_connections')
+    assert replicas.acquire() == 'a'
+    assert replicas.acquire() == 'b'
+    replicas.release('a')
+    assert replicas.acquire() == 'a'
+    assert replicas.acquire() in ('a', 'b')
+    assert dict(replicas.in_use()) in ({'a': 2, 'b': 1}, {'a': 1, 'b': 2})
+
+
+def test_lru_query_cache_evicts_least_recently_used():
+    cache = LRUQueryCache(max_size=2)
+    cache.set('a', 1, ttl=60)
+    cache.set('b', 2, ttl=60)
+    assert cache.get('a') == 1
+    cache.set('c', 3, ttl=60)
+    assert [cache.get(key) for key in 'abc'] == [1, None, 3]
+    cache.set('d', 4, ttl=-1)
+    assert cache.get('d') is None
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_lru_query_cache_invalidation_changes_keys():
+    cache = LRUQueryCache()
+    key = cache.key('q', ['User', 'Group'])
+    assert cache.key('q', ['User', 'Group']) == key
+    cache.invalidate(['Other'])
+    assert cache.key('q', ['User', 'Group']) == key
+    cache.invalidate(['User'])
+    assert cache.key('q', ['User', 'Group']) != key
+
+
+def test_statement_shape():
+    assert _statement_shape("SELECT * FROM t\n WHERE id = 12 AND name = 'it''s' AND t2.x = 1.5") == \
+        'SELECT * FROM t WHERE id = ? AND name = ? AND t2.x = ?'
+
+
+@pytest.mark.parametrize('kwargs, listens, recording, shapes', [
+    ({}, False, False, False),
+    ({'slow_query_ms': 100}, True, False, False),
+    ({'record_stats': True}, True, True, False),
+    ({'repeated_query_threshold': 5}, True, True, True),
+])
+def test_query_instrumentation_is_only_attached_if_used(kwargs, listens, recording, shapes):
+    instrumentation = QueryInstrumentation(**kwargs)
+    engine = create_engine('sqlite://')
+    instrumentation.attach(engine)
+    assert bool(engine.dispatch.after_cursor_execute) == listens
+    with instrumentation.record() as stats:
+        engine.execute('SELECT 1')
+    if not recording:
+        assert stats is None
+    else:
+        assert stats.count == 1
+        assert bool(stats.shapes) == shapes
@@ -1,8 +1,8 @@
 import gevent
-from injector import Module, MappingKey, inject, singleton, provides
+from injector import MappingKey, inject, singleton, provides
 from gevent.backdoor import BackdoorServer
 
-from waffle.flags import Flag
+from waffle.flags import Flag, Module
 
 
 DebugConsoleContext = MappingKey('DebugConsoleContext')
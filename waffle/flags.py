@@ -1,10 +1,15 @@
+import os
 import sys
-import inspect
+import types
+from collections import namedtuple
 from functools import wraps
-from itertools import chain
 
-from argparse import ArgumentParser, HelpFormatter, SUPPRESS, OPTIONAL, ZERO_OR_MORE
-from injector import Injector, Binder, Module, Key, SequenceKey, MappingKey, singleton, provides, inject
+from argparse import ArgumentParser, ArgumentTypeError, HelpFormatter, Namespace, SUPPRESS, OPTIONAL, \
+    ZERO_OR_MORE
+from injector import Injector, Binder, Module as InjectorModule, Key, SequenceKey, MappingKey, singleton, provides, \
+    inject
+
+from waffle.startup import BootstrapCache, NullProfiler, StartupProfiler, run_startup_hooks, warm_up_singletons
 
 
 """A configuration system backed by flags and files.
@@ -19,6 +24,12 @@ from injector import Injector, Binder, Module, Key, SequenceKey, MappingKey, sin
 
 
 AppStartup = SequenceKey('AppStartup')
+# Callables called with injection before forking worker processes, and in each
+# worker after forking. Used to reset fork-unsafe state such as connection pools.
+BeforeFork = SequenceKey('BeforeFork')
+AfterFork = SequenceKey('AfterFork')
+# Interfaces to construct at startup with --warmup, in addition to all singleton bindings.
+Warmup = SequenceKey('Warmup')
 # Parsed command line arguments can be injected with this key, or individually with FlagKey(name)
 Flags = Key('Flags')
 _ProvidedFlags = SequenceKey('_ProvidedFlags')
@@ -71,6 +82,26 @@ class _ProvideFlag(object):
         except:
             return self
 
+    def providers(self):
+        """Create the @provides methods that register this flag with a Module.
+
+        One provides the initial flag parameters, the other the final flag value.
+        """
+        dest, args, kwargs = self._dest, self._args, self._kwargs
+
+        @provides(_ProvidedFlags)
+        def provide_flag(self):
+            return [(args, kwargs)]
+        provide_flag.__name__ = 'provides_flag_' + dest
+
+        @provides(FlagKey(dest), scope=singleton)
+        @inject(flags=Flags)
+        def provide_flag_value(self, flags):
+            return getattr(flags, dest)
+        provide_flag_value.__name__ = 'provides_flag_value_' + dest
+
+        return {provide_flag.__name__: provide_flag, provide_flag_value.__name__: provide_flag_value}
+
 
 def _extract_dest(args, kwargs):
     if 'dest' in kwargs:
@@ -84,6 +115,98 @@ def _extract_dest(args, kwargs):
     return args[0]
 
 
+_FlagSpec = namedtuple('_FlagSpec', 'dest action type default required choices simple')
+
+# Actions understood by _FlagTable.parse(). Anything else goes through argparse.
+_SIMPLE_ACTIONS = frozenset([None, 'store', 'store_true', 'store_false', 'append'])
+_IMPLICIT_DEFAULTS = {'store_true': False, 'store_false': True}
+
+
+class _FlagTable(object):
+    """A precomputed table of flag specifications.
+
+    Parses the common forms of command line (--flag, --flag=value, --flag value)
+    without constructing an ArgumentParser. Anything else, including --help,
+    abbreviated or unknown flags and invalid values, is left to argparse so that
+    it can produce its usual help and error messages.
+    """
+
+    def __init__(self, flags):
+        self.specs = []
+        self.options = {}
+        self.simple = True
+        for args, kwargs in flags:
+            if not args or not all(arg.startswith('-') for arg in args):
+                # Positional arguments are left to argparse.
+                self.simple = False
+                continue
+            action = kwargs.get('action')
+            spec = _FlagSpec(
+                dest=kwargs.get('dest') or _extract_dest(args, {}).replace('-', '_'),
+                action=action,
+                type=kwargs.get('type'),
+                default=kwargs.get('default', _IMPLICIT_DEFAULTS.get(action)),
+                required=kwargs.get('required', False),
+                choices=kwargs.get('choices'),
+                simple=action in _SIMPLE_ACTIONS and 'nargs' not in kwargs and 'const' not in kwargs,
+                )
+            self.specs.append(spec)
+            for arg in args:
+                self.options[arg] = spec
+
+    def _convert(self, spec, value):
+        if spec.type is None:
+            return value
+        try:
+            return spec.type(value)
+        except (TypeError, ArgumentTypeError):
+            raise ValueError(value)
+
+    def parse(self, args, defaults):
+        """Parse args into a Namespace, or return None if argparse is required."""
+        if not self.simple:
+            return None
+        values = dict(defaults)
+        seen = set(values)
+        try:
+            for spec in self.specs:
+                default = values.get(spec.dest, spec.default)
+                # argparse converts string defaults, including those given by
+                # FlagDefaults, as if they were given on the command line.
+                if isinstance(default, basestring):
+                    default = self._convert(spec, default)
+                values[spec.dest] = default
+            args = iter(args)
+            for arg in args:
+                option, equals, value = arg.partition('=') if arg.startswith('--') else (arg, '', None)
+                spec = self.options.get(option)
+                if spec is None or not spec.simple:
+                    return None
+                seen.add(spec.dest)
+                if spec.action in ('store_true', 'store_false'):
+                    if equals:
+                        return None
+                    values[spec.dest] = spec.action == 'store_true'
+                    continue
+                if not equals:
+                    value = next(args, None)
+                    if value is None or value.startswith('-'):
+                        return None
+                value = self._convert(spec, value)
+                if spec.choices is not None and value not in spec.choices:
+                    return None
+                if spec.action == 'append':
+                    values[spec.dest] = list(values[spec.dest] or []) + [value]
+                else:
+                    values[spec.dest] = value
+        except ValueError:
+            return None
+        for spec in self.specs:
+            if spec.required and spec.dest not in seen:
+                return None
+        return Namespace(**values)
+
+
 def Flag(*args, **kwargs):
     """Provide a flag from an Injector module.
 
@@ -92,69 +215,184 @@ def Flag(*args, **kwargs):
 
     This flag is available as a property to that module, and via injection
     with FlagKey('debug').
+
+    Modules deriving from :class:`waffle.flags.Module` register their flags
+    when they are installed. Flags of other injector modules are registered
+    when they are installed after :class:`FlagsModule`.
     """
+    return _ProvideFlag(_extract_dest(args, kwargs), *args, **kwargs)
 
-    dest = _extract_dest(args, kwargs)
 
-    @provides(_ProvidedFlags)
-    def provide_flag(self):
-        return [(args, kwargs)]
-    provide_flag.__name__ = 'provides_flag_' + dest
+def _declared_flags(cls):
+    """Return the Flag() declarations on cls and its bases, sorted by dest."""
+    flags = {}
+    for base in reversed(cls.__mro__):
+        for value in base.__dict__.values():
+            if isinstance(value, _ProvideFlag):
+                flags[value._dest] = value
+    return sorted(flags.values(), key=lambda f: f._dest)
+
+
+def _register_flags(cls):
+    """Add the @provides methods for Flag() declarations on cls and its bases.
+
+    This happens once per class, the first time it is installed, and records the
+    declarations in cls.__declared_flags__.
+    """
+    if '__declared_flags__' in cls.__dict__:
+        return cls.__declared_flags__
+    flags = _declared_flags(cls)
+    for value in flags:
+        for name, provider in value.providers().items():
+            setattr(cls, name, provider)
+    cls.__declared_flags__ = flags
+    return flags
+
+
+def _bind_provider(binder, module, provider):
+    binding = provider.__binding__
+    binder.bind(binding.interface, to=types.MethodType(binding.provider, module), scope=binding.scope)
+
+
+def _scan_providers(cls):
+    """Find @provides methods on cls without triggering descriptors (such as flags)."""
+    providers = []
+    for name in dir(cls):
+        for base in cls.__mro__:
+            if name in base.__dict__:
+                if isinstance(base.__dict__[name], types.FunctionType) and \
+                        hasattr(base.__dict__[name], '__binding__'):
+                    providers.append(name)
+                break
+    return providers
+
+
+class Module(InjectorModule):
+    """An Injector module that can declare flags with :func:`Flag`.
+
+    The @provides methods of each Module class are found once per process and
+    recorded in cls.__providers__, rather than by scanning the module on every
+    install. With --bootstrap_cache they are also saved across starts.
+    """
+
+    def __call__(self, binder):
+        cls = type(self)
+        _register_flags(cls)
+        self.__injector__ = binder.injector
+        for name in _providers(binder, cls):
+            _bind_provider(binder, self, getattr(cls, name))
+        self.configure(binder)
 
-    @provides(FlagKey(dest), scope=singleton)
-    @inject(flags=Flags)
-    def provide_flag_value(self, flags):
-        return getattr(flags, dest)
-    provide_flag_value.__name__ = 'provides_flag_value_' + dest
 
-    # There is a bit of magic here. We basically inject two @provide methods
-    # into the calling scope. They provide the initial flag parameters, and the
-    # final flag value.
-    frames = inspect.stack()
-    frames[1][0].f_locals[provide_flag.__name__] = provide_flag
-    frames[1][0].f_locals[provide_flag_value.__name__] = provide_flag_value
+def _providers(binder, cls):
+    """Return the names of the @provides methods of cls, scanning it once per process."""
+    providers = cls.__dict__.get('__providers__')
+    if providers is None:
+        cache = getattr(binder.injector, '__bootstrap_cache__', None)
+        providers = cache.providers(cls, _scan_providers) if cache is not None else _scan_providers(cls)
+        cls.__providers__ = providers
+    return providers
 
-    return _ProvideFlag(dest, *args, **kwargs)
+
+def _is_plain_module_with_flags(cls):
+    return issubclass(cls, InjectorModule) and not issubclass(cls, Module) and \
+        cls.__call__.im_func is InjectorModule.__call__.im_func and bool(_declared_flags(cls))
+
+
+def _install_flags_of_plain_modules(binder):
+    """Make binder install injector.Modules that declare flags as a waffle.flags.Module would.
+
+    injector.Module reads every attribute of a module to find its providers,
+    which would read its flags before they are parsed. Instead, its providers
+    and flags are bound explicitly, before it is configured. The flag
+    providers are not added to the class, so the module can be installed in
+    other injectors either way.
+    """
+    install = binder.install
+    if getattr(install, '__installs_flags__', False):
+        return
+
+    def install_with_flags(module):
+        if isinstance(module, type) and _is_plain_module_with_flags(module):
+            module = binder.injector.create_object(module)
+        if not isinstance(module, type) and _is_plain_module_with_flags(type(module)):
+            cls = type(module)
+            module.__injector__ = binder.injector
+            for name in _providers(binder, cls):
+                _bind_provider(binder, module, getattr(cls, name))
+            for flag in _declared_flags(cls):
+                for provider in flag.providers().values():
+                    _bind_provider(binder, module, provider)
+            module.configure(binder)
+        else:
+            install(module)
+
+    install_with_flags.__installs_flags__ = True
+    binder.install = install_with_flags
 
 
 class FlagsModule(Module):
     """Provide flags to an Injector."""
 
     debug = Flag('--debug', help='Enable debug mode.', action='store_true')
+    profile_startup = Flag('--profile_startup', help='Report time spent in each phase of startup.',
+                           action='store_true')
+    profile_startup_output = Flag('--profile_startup_output', metavar='FILE',
+                                  help='Write the --profile_startup report to FILE as JSON.')
+    startup_threads = Flag('--startup_threads', metavar='N', type=int, default=1,
+                           help='Number of threads to run independent AppStartup hooks on.')
+    warmup = Flag('--warmup', action='store_true',
+                  help='Construct all singletons at startup, rather than on first use.')
+    bootstrap_cache = Flag('--bootstrap_cache', metavar='FILE',
+                           help='Save the @provides methods found on modules in FILE, for faster startup.')
 
     def __init__(self, args, defaults=None):
         self.args = args
         self.defaults = defaults or {}
 
+    def _defaults(self, defaults):
+        defaults = dict(defaults)
+        defaults.update(self.defaults)
+        return defaults
+
+    @provides(_FlagTable, scope=singleton)
+    @inject(flags=_ProvidedFlags)
+    def provide_flag_table(self, flags):
+        return _FlagTable(flags)
+
     @provides(ArgumentParser, scope=singleton)
-    @inject(binder=Binder, flags=_ProvidedFlags)
-    def provide_argh_parser(self, binder, flags):
-        parser = ArgumentParser(fromfile_prefix_chars='@', formatter_class=ArgumentDefaultsHelpFormatter)
+    @inject(flags=_ProvidedFlags, defaults=FlagDefaults)
+    def provide_argh_parser(self, flags, defaults):
+        defaults = self._defaults(defaults)
+        prog = os.path.basename(self.args[0]) if self.args else None
+        parser = ArgumentParser(prog=prog, fromfile_prefix_chars='@', formatter_class=ArgumentDefaultsHelpFormatter)
         for args, kwargs in flags:
-            parser.add_argument(*args, **kwargs)
+            action = parser.add_argument(*args, **kwargs)
+            # Defaults satisfy "required" arguments.
+            if action.dest in defaults:
+                action.required = False
+        parser.set_defaults(**defaults)
         return parser
 
     @provides(Flags, scope=singleton)
-    @inject(parser=ArgumentParser, defaults=FlagDefaults)
-    def provide_flags(self, parser, defaults):
-        parser.set_defaults(**defaults)
-        parser.set_defaults(**self.defaults)
-        # NOTE: parser.set_defaults() does not satisfy "required" arguments,
-        # so we synthesize flags in order to override them. Annoying. Bug?
-        default_args = []
-        for k, v in chain(defaults.iteritems(), self.defaults.iteritems()):
-            if isinstance(v, bool):
-                default_args.append('--%s' % k)
-            else:
-                default_args.append('--%s=%s' % (k, v))
-        return parser.parse_args(default_args + self.args[1:])
+    @inject(table=_FlagTable, defaults=FlagDefaults, binder=Binder)
+    def provide_flags(self, table, defaults, binder):
+        flags = table.parse(self.args[1:], self._defaults(defaults))
+        if flags is None:
+            # Help, errors and less common argument forms are handled by argparse.
+            flags = binder.injector.get(ArgumentParser).parse_args(self.args[1:])
+        return flags
 
     def configure(self, binder):
+        _install_flags_of_plain_modules(binder)
         binder.multibind(FlagDefaults, to={}, scope=singleton)
         binder.multibind(_ProvidedFlags, to=[], scope=singleton)
+        binder.multibind(Warmup, to=[])
+        binder.multibind(BeforeFork, to=[])
+        binder.multibind(AfterFork, to=[])
 
 
-class FlagModule(Module):
+class FlagModule(InjectorModule):
     """A module providing a single flag."""
 
     def __init__(self, args, kwargs):
@@ -182,24 +420,81 @@ def flag(*args, **kwargs):
     return wrap
 
 
+def _import_module(name):
+    """Import a module given as a dotted path, eg. 'waffle.redis.RedisModule'."""
+    module_name, _, attr = name.rpartition('.')
+    return getattr(__import__(module_name, None, None, [attr]), attr)
+
+
+def _startup_flag(args, defaults, name, takes_value=False):
+    """Find the value of a flag that is needed before the injector is configured."""
+    option = '--' + name
+    value = (defaults or {}).get(name)
+    args = iter(args[1:])
+    for arg in args:
+        if takes_value and arg.startswith(option + '='):
+            value = arg[len(option) + 1:]
+        elif arg == option:
+            value = next(args, None) if takes_value else True
+    return value
+
+
 def create_injector_from_flags(args=None, modules=[], defaults=None, **kwargs):
     """Create an application Injector from command line flags.
 
-    Calls all AppStartup hooks.
+    Modules may be given as dotted paths, in which case they are imported here.
+
+    Calls all AppStartup hooks, concurrently on --startup_threads threads
+    where they do not depend on each other (see :func:`waffle.startup.startup_after`).
+
+    With --warmup, all singletons (and interfaces contributed to Warmup) are
+    then constructed.
+
+    With --bootstrap_cache=FILE, the @provides methods found on each module
+    class are saved to FILE and reused by later starts until the source of the
+    module changes.
+
+    With --profile_startup, the time spent importing and installing modules,
+    invoking providers, running AppStartup hooks and warming up singletons is
+    reported once startup completes.
     """
     if args is None:
         args = sys.argv
-    modules = [FlagsModule(args, defaults=defaults)] + modules
-    injector = Injector(modules, **kwargs)
-    injector.binder.multibind(AppStartup, to=[])
-    for startup in injector.get(AppStartup):
-        injector.call_with_injection(startup)
+    profiling = _startup_flag(args, defaults, 'profile_startup')
+    profiler = StartupProfiler() if profiling else NullProfiler()
+    injector = Injector(**kwargs)
+    bootstrap_cache = _startup_flag(args, defaults, 'bootstrap_cache', takes_value=True)
+    if bootstrap_cache:
+        injector.__bootstrap_cache__ = BootstrapCache(bootstrap_cache)
+    profiler.attach(injector)
+    try:
+        for module in [FlagsModule(args, defaults=defaults)] + modules:
+            if isinstance(module, basestring):
+                with profiler.timed('import', module):
+                    module = _import_module(module)
+            injector.binder.install(module)
+        if bootstrap_cache:
+            injector.__bootstrap_cache__.save()
+        injector.binder.multibind(AppStartup, to=[])
+        hooks = injector.get(AppStartup)
+        if hooks:
+            run_startup_hooks(injector, hooks, injector.get(FlagKey('startup_threads')), profiler)
+        if injector.get(FlagKey('warmup')):
+            # The ArgumentParser is only needed for --help and errors.
+            warm_up_singletons(injector, injector.get(Warmup), profiler, exclude=[ArgumentParser])
+    finally:
+        profiler.detach(injector)
+    if profiling:
+        profiler.report(injector.get(Flags).profile_startup_output)
     return injector
 
 
 def modules(*modules):
     """A decorator that specifies Injector modules to use when bootstrapping the application.
 
+    Modules may be given as dotted paths (eg. 'waffle.redis.RedisModule') to
+    defer importing them until the application starts.
+
     See :func:`main` for details.
     """
     def wrapper(f):
@@ -208,6 +503,84 @@ def modules(*modules):
     return wrapper
 
 
+def commands(*commands):
+    """A decorator that adds subcommands to the main entry point.
+
+    Each command is a function, named on the command line by its __name__,
+    that may declare its own modules and flags with @modules and @flag. Only
+    the modules of the command being run are installed, and so only their
+    flags are parsed. Modules given as dotted paths are only imported if their
+    command is run.
+
+    See :func:`main` for details.
+    """
+    def wrapper(f):
+        f.__commands__ = getattr(f, '__commands__', []) + list(commands)
+        return f
+    return wrapper
+
+
+# Actions whose flags never consume the following argument.
+_NO_VALUE_ACTIONS = frozenset(['store_true', 'store_false', 'store_const', 'append_const', 'count', 'help',
+                               'version'])
+
+
+def _value_options(modules):
+    """Return the options declared by FlagsModule and modules that take a value.
+
+    Modules given as dotted paths are not imported, so their flags are not included.
+    """
+    declared = [(flag._args, flag._kwargs) for flag in _declared_flags(FlagsModule)]
+    for module in modules:
+        if isinstance(module, FlagModule):
+            declared.append((module._args, module._kwargs))
+        elif not isinstance(module, basestring):
+            cls = module if isinstance(module, type) else type(module)
+            declared.extend((flag._args, flag._kwargs) for flag in _declared_flags(cls))
+    options = set()
+    for args, kwargs in declared:
+        if kwargs.get('action') not in _NO_VALUE_ACTIONS and kwargs.get('nargs') != 0:
+            options.update(arg for arg in args if arg.startswith('-'))
+    return options
+
+
+def _select_command(args, commands, modules=[]):
+    """Find the command named in args, returning it and args without the command name.
+
+    Arguments that are the value of a flag declared by modules, or by the
+    modules of a command, are skipped.
+    """
+    names = dict((command.__name__, command) for command in commands)
+    command_modules = [module for command in commands for module in getattr(command, '__injector_modules__', [])]
+    options = _value_options(list(modules) + command_modules)
+    skip = False
+    for i, arg in enumerate(args[1:], 1):
+        if skip:
+            skip = False
+            continue
+        if arg in options:
+            skip = True
+        elif arg in names:
+            prog = '%s %s' % (os.path.basename(args[0]), arg)
+            return names[arg], [prog] + args[1:i] + args[i + 1:]
+    return None, args
+
+
+def _exit_with_command_usage(args, commands):
+    prog = os.path.basename(args[0])
+    width = max(len(command.__name__) for command in commands)
+    lines = ['usage: %s [flags] COMMAND [flags]' % prog, '', 'commands:']
+    for command in commands:
+        summary = (command.__doc__ or '').strip().split('\n')[0]
+        lines.append('  %-*s  %s' % (width, command.__name__, summary))
+    if '-h' in args or '--help' in args:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.exit(0)
+    lines.append('%s: error: a command is required' % prog)
+    sys.stderr.write('\n'.join(lines) + '\n')
+    sys.exit(2)
+
+
 def main(_f=None, **defaults):
     """A decorator that marks and runs the main entry point.
 
@@ -225,16 +598,44 @@ def main(_f=None, **defaults):
         @modules(MyMainModule, AppModules, WebModules)
         def main():
             pass
+
+    With @commands, the first argument naming a command, other than the value
+    of a flag, selects the command to run. Flags of modules given as dotted
+    paths are not known at this point, so their values should be given as
+    --flag=value. Modules given to @modules on the main function are installed for
+    every command, and the main function is called before the command:
+
+        @modules('waffle.web.common.WebModules')
+        @inject(app=WebApplication)
+        def serve(app):
+            app.serve()
+
+        @main(database_uri='sqlite:///t.db')
+        @modules(AppModules)
+        @commands(serve, backfill)
+        def main():
+            pass
     """
     def wrapper(f):
         modules = getattr(f, '__injector_modules__', [])
-        injector = create_injector_from_flags(modules=modules, defaults=defaults)
+        commands = getattr(f, '__commands__', [])
+        args = sys.argv
+        command = None
+        if commands:
+            command, args = _select_command(args, commands, modules)
+            if command is None:
+                _exit_with_command_usage(args, commands)
+            modules = modules + getattr(command, '__injector_modules__', [])
+        injector = create_injector_from_flags(args, modules=modules, defaults=defaults)
 
         @wraps(f)
         def inner():
             # Force all flags to be parsed.
             injector.get(Flags)
-            return injector.call_with_injection(f)
+            result = injector.call_with_injection(f)
+            if command is not None:
+                result = injector.call_with_injection(command)
+            return result
 
         inner()
 
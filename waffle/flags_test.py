@@ -1,6 +1,10 @@
+import inspect
+
+import pytest
 from injector import Injector, Module
 
-from .flags import FlagsModule, Flag, FlagKey
+from . import flags
+from .flags import FlagsModule, Flag, FlagKey, Flags
 
 
 class TestModule(Module):
@@ -16,3 +20,166 @@ def test_flag():
     injector = Injector([FlagsModule(['test'], {'flag2': 2}), TestModule()])
     assert injector.get(FlagKey('flag1')) == 1
     assert injector.get(FlagKey('flag2')) == 2
+
+
+def test_flag_declaration_does_not_inspect_stack(monkeypatch):
+    def stack(*args, **kwargs):
+        raise AssertionError('inspect.stack() called')
+    monkeypatch.setattr(inspect, 'stack', stack)
+
+    class StacklessModule(flags.Module):
+        flag3 = Flag('--flag3', default=3, type=int)
+
+    injector = Injector([FlagsModule(['test']), StacklessModule])
+    assert injector.get(FlagKey('flag3')) == 3
+    assert hasattr(StacklessModule, 'provides_flag_flag3')
+    assert hasattr(StacklessModule, 'provides_flag_value_flag3')
+
+
+def test_flags_of_plain_injector_modules_are_registered_once_per_injector():
+    class PlainModule(Module):
+        flag4 = Flag('--flag4', type=int)
+
+    module = PlainModule()
+    for value in (4, 5):
+        injector = Injector([FlagsModule(['test', '--flag4=%d' % value]), module])
+        assert injector.get(FlagKey('flag4')) == value
+        assert module.flag4 == value
+    assert not hasattr(PlainModule, 'provides_flag_flag4')
+    injector = flags.create_injector_from_flags(['test', '--flag4=6'], modules=[PlainModule])
+    assert injector.get(FlagKey('flag4')) == 6
+
+
+def test_reading_flags_of_plain_injector_modules_has_no_effect():
+    class PlainModule(Module):
+        flag5 = Flag('--flag5', type=int)
+
+    module = PlainModule()
+    assert isinstance(module.flag5, flags._ProvideFlag)
+    # Without FlagsModule installed first, the module is installed by injector and its flags are not bound.
+    injector = Injector([module, FlagsModule(['test'])])
+    assert isinstance(module.flag5, flags._ProvideFlag)
+    assert 'flag5' not in vars(injector.get(Flags))
+
+
+class ParsingModule(Module):
+    port = Flag('--port', type=int, default='8080')
+    name = Flag('--name', required=True)
+    verbose = Flag('-v', '--verbose', action='store_true')
+    levels = Flag('-L', '--levels', action='append', default=[])
+    mode = Flag('--mode', choices=['a', 'b'], default='a')
+
+
+def parse(args, defaults=None):
+    injector = Injector([FlagsModule(['test'] + args, defaults), ParsingModule()])
+    return injector.get(Flags)
+
+
+def test_flags_are_parsed_without_argument_parser(monkeypatch):
+    def argument_parser(*args, **kwargs):
+        raise AssertionError('ArgumentParser constructed')
+    monkeypatch.setattr(flags, 'ArgumentParser', argument_parser)
+
+    parsed = parse(['--port=80', '-v', '-L', 'a=b', '--levels', 'c=d', '--mode', 'b'], {'name': 'bob'})
+    assert parsed.port == 80
+    assert parsed.name == 'bob'
+    assert parsed.verbose is True
+    assert parsed.levels == ['a=b', 'c=d']
+    assert parsed.mode == 'b'
+
+
+def test_flag_defaults_are_converted_like_argparse():
+    parsed = parse([], {'name': 'bob', 'verbose': False})
+    assert parsed.port == 8080
+    assert parsed.verbose is False
+    assert parsed.levels == []
+    assert parse([], {'name': 'bob', 'port': '81'}).port == 81
+    assert parse(['--na', 'bob'], {'port': '82'}).port == 82
+
+
+def test_argparse_handles_uncommon_forms():
+    parsed = parse(['--na', 'bob', '--port', '81'])
+    assert parsed.name == 'bob'
+    assert parsed.port == 81
+
+
+def test_argparse_reports_errors():
+    with pytest.raises(SystemExit):
+        parse(['--mode', 'c'], {'name': 'bob'})
+    with pytest.raises(SystemExit):
+        parse([])
+
+
+installed = []
+
+
+class BackfillModule(Module):
+    since = Flag('--since', required=True)
+
+    def configure(self, binder):
+        installed.append('backfill')
+
+
+class ServeModule(Module):
+    port = Flag('--port', type=int, default=8080)
+
+    def configure(self, binder):
+        installed.append('serve')
+
+
+@flags.modules(BackfillModule)
+@flags.inject(since=FlagKey('since'))
+def backfill(since):
+    """Backfill from a date."""
+    return installed.append('backfill ' + since)
+
+
+@flags.modules(ServeModule)
+def serve():
+    """Serve the application."""
+    installed.append('serving')
+
+
+def run_commands(monkeypatch, *args):
+    del installed[:]
+    monkeypatch.setattr('sys.argv', ['tool'] + list(args))
+
+    @flags.flag('--verbose', action='store_true')
+    @flags.flag('--mode', default='')
+    @flags.commands(serve, backfill)
+    @flags.inject(verbose=FlagKey('verbose'))
+    def main(verbose):
+        installed.append('main verbose=%s' % verbose)
+
+    flags.main(main)
+
+
+def test_main_installs_only_the_selected_command(monkeypatch):
+    run_commands(monkeypatch, '--verbose', 'backfill', '--since', '2014-01-01')
+    assert installed == ['backfill', 'main verbose=True', 'backfill 2014-01-01']
+    # --since is required by backfill, but not parsed for serve.
+    run_commands(monkeypatch, 'serve', '--port', '81')
+    assert installed == ['serve', 'main verbose=False', 'serving']
+
+
+def test_main_skips_flag_values_when_selecting_the_command(monkeypatch):
+    run_commands(monkeypatch, '--mode', 'serve', 'backfill', '--since', 'serve')
+    assert installed == ['backfill', 'main verbose=False', 'backfill serve']
+    run_commands(monkeypatch, '--since', 'serve', 'backfill')
+    assert installed == ['backfill', 'main verbose=False', 'backfill serve']
+
+
+def test_main_rejects_flags_of_other_commands(monkeypatch):
+    with pytest.raises(SystemExit):
+        run_commands(monkeypatch, 'serve', '--since', '2014-01-01')
+
+
+def test_main_requires_a_command(monkeypatch, capsys):
+    with pytest.raises(SystemExit) as e:
+        run_commands(monkeypatch)
+    assert e.value.code == 2
+    assert 'backfill  Backfill from a date.' in capsys.readouterr()[1]
+    with pytest.raises(SystemExit) as e:
+        run_commands(monkeypatch, '--help')
+    assert e.value.code == 0
+    assert 'serve     Serve the application.' in capsys.readouterr()[0]
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import waffle
+
+
+"""Checks of the third-party packages imported by the public names of the waffle package.
+
+Each name is resolved in a fresh interpreter, which reports the modules it
+imported. Import times are measured by benchmarks/import_time.py.
+"""
+
+
+# Third-party packages that are expensive to import, and so must only be
+# imported by the names that need them. They are all optional dependencies.
+HEAVY_PACKAGES = frozenset(['sqlalchemy', 'jinja2', 'clastic', 'werkzeug', 'redis', 'gevent', 'waitress', 'argh',
+                            'colorlog'])
+
+# Origin module: heavy packages it may import.
+ALLOWED_IMPORTS = {
+    'waffle.common':        [],
+    'waffle.db':            ['sqlalchemy'],
+    'waffle.devel':         ['gevent'],
+    'waffle.flags':         [],
+    'waffle.log':           [],
+    'waffle.redis':         ['redis'],
+    'waffle.startup':       [],
+    'waffle.template':      ['jinja2'],
+    'waffle.util':          [],
+    'waffle.web.clastic':   ['clastic', 'werkzeug'],
+    'waffle.web.common':    [],
+    'waffle.web.csrf':      ['clastic', 'werkzeug', 'jinja2'],
+    'waffle.web.db':        ['clastic', 'werkzeug', 'sqlalchemy'],
+    'waffle.web.prefork':   [],
+    'waffle.web.template':  ['clastic', 'werkzeug', 'jinja2'],
+}
+
+MEASURE_IMPORTS = r'''
+import __builtin__, json, sys
+
+origins = []
+real_import = __builtin__.__import__
+
+
+def recording_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if fromlist and sys.argv[1] in fromlist:
+        origins.append(name)
+    return real_import(name, globals, locals, fromlist, level)
+
+__builtin__.__import__ = recording_import
+import waffle
+try:
+    getattr(waffle, sys.argv[1])
+except ImportError as e:
+    json.dump({'missing': str(e).split()[-1]}, sys.stdout)
+    sys.exit(0)
+__builtin__.__import__ = real_import
+json.dump({'modules': [name for name, module in sys.modules.items() if module is not None], 'origin': origins[0]},
+          sys.stdout)
+'''
+
+
+def run_python(script, *args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(waffle.__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    return json.loads(subprocess.check_output([sys.executable, '-c', script] + list(args), env=env))
+
+
+def measure_import(name):
+    """Resolve waffle.<name> in a fresh interpreter.
+
+    Returns the modules imported and the module the name is defined in, or
+    the name of a missing module.
+    """
+    return run_python(MEASURE_IMPORTS, name)
+
+
+@pytest.mark.parametrize('name', sorted(waffle.__all__))
+def test_imports(name):
+    result = measure_import(name)
+    if 'missing' in result:
+        missing = result['missing'].split('.')[0]
+        if missing not in HEAVY_PACKAGES:
+            raise AssertionError('waffle.%s could not be imported: no module named %s' % (name, result['missing']))
+        pytest.skip('optional dependency %s is not installed' % missing)
+    allowed = ALLOWED_IMPORTS[result['origin']]
+    heavy = set(module.split('.')[0] for module in result['modules']) & HEAVY_PACKAGES
+    assert heavy <= set(allowed), 'waffle.%s imports %s' % (name, ', '.join(sorted(heavy - set(allowed))))
@@ -1,13 +1,9 @@
 import logging
 
-from injector import Module, Key, Binder, provides, inject
+from injector import Key, Binder, provides, inject
 from logging import Formatter
-try:
-    from colorlog import ColoredFormatter
-except ImportError:
-    ColoredFormatter = None
 
-from waffle.flags import Flag, FlagKey, AppStartup
+from waffle.flags import Flag, FlagKey, AppStartup, Module
 
 
 LogLevel = Key('LogLevel')
@@ -39,6 +35,15 @@ def _configure_logging():
 _configure_logging()
 
 
+def _colored_formatter():
+    """Import colorlog's formatter on first use, returning None if it is not installed."""
+    try:
+        from colorlog import ColoredFormatter
+    except ImportError:
+        return None
+    return ColoredFormatter
+
+
 class LoggingModule(Module):
     """Configure some default logging.
 
@@ -69,7 +74,8 @@ class LoggingModule(Module):
         map(root.removeHandler, root.handlers[:])
         map(root.removeFilter, root.filters[:])
 
-        if self.log_to_stdout and ColoredFormatter:
+        ColoredFormatter = self.log_to_stdout and _colored_formatter()
+        if ColoredFormatter:
             formatter = ColoredFormatter(
                 '%(log_color)s' + self.log_format,
                 datefmt=None,
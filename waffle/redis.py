@@ -2,9 +2,9 @@ from __future__ import absolute_import
 import logging
 
 from redis import Redis
-from injector import Module, singleton, provides
+from injector import inject, singleton, provides
 
-from waffle.flags import Flag
+from waffle.flags import AfterFork, Flag, Module
 
 
 logger = logging.getLogger(__name__)
@@ -21,3 +21,12 @@ class RedisModule(Module):
         host, port, db = self.redis_server.split(':')
         port, db = int(port), int(db)
         return Redis(host, port, db)
+
+    @provides(AfterFork)
+    def provide_after_fork(self):
+        return [self.reset_connections]
+
+    @inject(redis=Redis)
+    def reset_connections(self, redis):
+        """Discard connections inherited from the parent process."""
+        redis.connection_pool.reset()
@@ -0,0 +1,445 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from functools import partial
+
+from injector import BindingKey, ScopeDecorator, SingletonScope
+
+
+"""Application startup: module scanning, AppStartup hooks, singleton warmup and instrumentation.
+
+Used by :func:`waffle.flags.create_injector_from_flags`.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+
+def describe(thing):
+    """A short human readable name for a module, key, class or callable."""
+    owner = getattr(thing, 'im_class', None)
+    name = getattr(thing, '__name__', None) or type(thing).__name__
+    if owner is not None:
+        return '%s.%s' % (owner.__name__, name)
+    return name
+
+
+def _source_file(module_name):
+    filename = getattr(sys.modules.get(module_name), '__file__', None)
+    if filename and filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+        filename = filename[:-1]
+    return filename
+
+
+def _file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return [filename, stat.st_mtime, stat.st_size]
+
+
+def _file_digest(filename):
+    try:
+        with open(filename, 'rb') as fd:
+            return hashlib.sha1(fd.read()).hexdigest()
+    except IOError:
+        return None
+
+
+class BootstrapCache(object):
+    """The @provides methods found on each Module class, saved in a file across starts.
+
+    Installing a module requires scanning every attribute of its class for
+    @provides methods. The names found are saved with the mtime, size and
+    SHA-1 of the source files of the class and its bases. Later starts use an
+    entry while each file has the same mtime and size or, failing that, the
+    same SHA-1, so entries are discarded when the source changes.
+    """
+
+    VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+        self._changed = False
+        # Filename -> [filename, mtime, size, sha1], computed at most once per start.
+        self._sources = {}
+        try:
+            with open(filename) as fd:
+                cache = json.load(fd)
+        except (IOError, ValueError):
+            return
+        if isinstance(cache, dict) and cache.get('version') == self.VERSION:
+            self._entries = cache['classes']
+
+    def _source(self, filename, digest=True):
+        source = self._sources.get(filename)
+        if source is None or (digest and source[3] is None):
+            signature = _file_signature(filename)
+            if signature is None:
+                return None
+            source = self._sources[filename] = signature + [_file_digest(filename) if digest else None]
+        return source
+
+    def _unchanged(self, saved):
+        source = self._source(saved[0], digest=False)
+        if source is None:
+            return False
+        if source[1:3] == saved[1:3]:
+            return True
+        return self._source(saved[0])[3] == saved[3]
+
+    def providers(self, cls, scan):
+        """Return the names of the provider methods on cls, calling scan(cls) to find them if unknown."""
+        name = '%s.%s' % (cls.__module__, cls.__name__)
+        entry = self._entries.get(name)
+        if entry is not None and all(self._unchanged(source) for source in entry['sources']) and \
+                all(hasattr(getattr(cls, method, None), '__binding__') for method in entry['providers']):
+            if any(source[1:3] != self._sources[source[0]][1:3] for source in entry['sources']):
+                # Touched but unchanged: save the new mtimes so the files are not hashed again.
+                entry['sources'] = [self._source(source[0]) for source in entry['sources']]
+                self._changed = True
+            return entry['providers']
+        providers = scan(cls)
+        sources = [self._source(_source_file(base.__module__)) for base in cls.__mro__
+                   if base.__module__ not in ('__builtin__', 'injector')]
+        if None not in sources:
+            self._entries[name] = {'sources': sources, 'providers': providers}
+            self._changed = True
+        return providers
+
+    def save(self):
+        """Save the cache if any classes were scanned, logging rather than raising any error."""
+        if not self._changed:
+            return
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            with open(tmp, 'w') as fd:
+                json.dump({'version': self.VERSION, 'classes': self._entries}, fd)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save bootstrap cache %s: %s', self.filename, e)
+            return
+        self._changed = False
+
+
+class StartupProfiler(object):
+    """Record wall time spent in each phase of application startup.
+
+    Phases are nested: time spent in a phase while another is running is
+    attributed to both the inner and outer phase's total, but only to the inner
+    phase's own ("self") time.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.time()
+
+    @contextmanager
+    def timed(self, phase, name):
+        """Time the enclosed block as phase/name."""
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                record = self._records.setdefault((phase, name), [0, 0.0, 0.0])
+                record[0] += 1
+                record[1] += elapsed
+                record[2] += elapsed - children
+
+    def attach(self, injector):
+        """Time module installation and provider invocation on injector."""
+        binder = injector.binder
+        install, get = binder.install, injector.get
+
+        def timed_install(module):
+            with self.timed('configure', describe(module)):
+                return install(module)
+
+        def timed_get(interface, scope=None):
+            with self.timed('provide', describe(interface)):
+                return get(interface, scope)
+
+        binder.install = timed_install
+        injector.get = timed_get
+
+    def detach(self, injector):
+        """Remove instrumentation added by attach()."""
+        del injector.binder.install
+        del injector.get
+
+    def records(self):
+        """Return the recorded phases, slowest first."""
+        records = [
+            {'phase': phase, 'name': name, 'calls': calls,
+             'total_ms': total * 1000.0, 'self_ms': self_time * 1000.0}
+            for (phase, name), (calls, total, self_time) in self._records.items()
+        ]
+        records.sort(key=lambda r: (-r['total_ms'], r['phase'], r['name']))
+        return records
+
+    def report(self, output=None):
+        """Print a report sorted by total time, or write it as JSON if output is a filename."""
+        records = self.records()
+        elapsed = (time.time() - self._start) * 1000.0
+        if output:
+            with open(output, 'w') as fd:
+                json.dump({'total_ms': elapsed, 'phases': records}, fd, indent=2)
+            return
+        out = sys.stderr
+        print('Startup profile (%.1fms total):' % elapsed, file=out)
+        print('%10s %10s %6s  %-10s %s' % ('total ms', 'self ms', 'calls', 'phase', 'name'), file=out)
+        for record in records:
+            print('%(total_ms)10.1f %(self_ms)10.1f %(calls)6d  %(phase)-10s %(name)s' % record, file=out)
+
+
+class NullProfiler(object):
+    """A StartupProfiler that records nothing."""
+
+    @contextmanager
+    def timed(self, phase, name):
+        yield
+
+    def attach(self, injector):
+        pass
+
+    def detach(self, injector):
+        pass
+
+
+class StartupError(Exception):
+    """One or more AppStartup hooks failed.
+
+    :attr failures: A list of (hook name, formatted traceback) tuples.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(StartupError, self).__init__('%d startup hook(s) failed:\n\n%s' % (
+            len(failures), '\n'.join('%s:\n%s' % failure for failure in failures)))
+
+
+class WarmupError(StartupError):
+    """One or more singletons could not be constructed by :func:`warm_up_singletons`.
+
+    :attr failures: A list of (singleton name, formatted traceback) tuples.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, '%d singleton(s) failed to warm up:\n\n%s' % (
+            len(failures), '\n'.join('%s:\n%s' % failure for failure in failures)))
+
+
+def startup_after(*hooks):
+    """Declare AppStartup hooks that must complete before the decorated hook runs.
+
+        class DatabaseModule(Module):
+            @provides(AppStartup)
+            def provide_startup(self):
+                return [self.warm_pool]
+
+            @startup_after(LoggingModule.configure_logging)
+            def warm_pool(self):
+                ...
+
+    Dependencies on hooks that are not registered are ignored. Hooks without
+    dependencies between them may run concurrently (see --startup_threads).
+    """
+    def wrapper(f):
+        f.__startup_after__ = getattr(f, '__startup_after__', ()) + tuple(_hook_identity(h) for h in hooks)
+        return f
+    return wrapper
+
+
+def _hook_identity(hook):
+    # Bound methods are recreated on each attribute access, so compare the underlying functions.
+    return getattr(hook, 'im_func', hook)
+
+
+_PENDING, _RUNNING, _DONE, _FAILED = range(4)
+
+
+class _TaskRunner(object):
+    """Run tasks in order, subject to dependencies between them.
+
+    :param tasks: A list of (name, callable) tuples.
+    :param after: For each task, the indices of the tasks it must run after.
+    """
+
+    def __init__(self, tasks, after, phase, profiler):
+        self._tasks = tasks
+        self._after = after
+        self._phase = phase
+        self._profiler = profiler
+        self._state = [_PENDING] * len(tasks)
+        self._failures = []
+        self._condition = threading.Condition()
+        self._check_cycles()
+
+    def _check_cycles(self):
+        visiting, visited = set(), set()
+
+        def visit(i, path):
+            if i in visiting:
+                cycle = path[path.index(i):] + [i]
+                raise StartupError([('cycle', ' -> '.join(self._tasks[j][0] for j in cycle))])
+            if i in visited:
+                return
+            visiting.add(i)
+            for j in self._after[i]:
+                visit(j, path + [i])
+            visiting.discard(i)
+            visited.add(i)
+
+        for i in range(len(self._tasks)):
+            visit(i, [])
+
+    def _next(self):
+        """Claim the next runnable task, or return None. Must hold the condition."""
+        for i, state in enumerate(self._state):
+            if state != _PENDING:
+                continue
+            after = [self._state[j] for j in self._after[i]]
+            if _FAILED in after:
+                self._state[i] = _FAILED
+                self._failures.append((self._tasks[i][0], 'Skipped, a %s it depends on failed.\n' % self._phase))
+                self._condition.notify_all()
+            elif all(state == _DONE for state in after):
+                self._state[i] = _RUNNING
+                return i
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                i = self._next()
+                while i is None:
+                    if _PENDING not in self._state:
+                        return
+                    self._condition.wait()
+                    i = self._next()
+            name, task = self._tasks[i]
+            try:
+                with self._profiler.timed(self._phase, name):
+                    task()
+                self._finish(i)
+            except BaseException:
+                error = sys.exc_info()[1]
+                # Recorded even for eg. SystemExit, so that other workers do not wait for the task forever.
+                self._finish(i, (name, traceback.format_exc()))
+                if not isinstance(error, Exception):
+                    raise
+
+    def _finish(self, i, failure=None):
+        with self._condition:
+            self._state[i] = _DONE if failure is None else _FAILED
+            if failure is not None:
+                self._failures.append(failure)
+            self._condition.notify_all()
+
+    def run(self, threads):
+        if threads <= 1:
+            self._work()
+        else:
+            workers = [threading.Thread(target=self._work, name='%s-%d' % (self._phase, n))
+                       for n in range(min(threads, len(self._tasks)))]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+        if self._failures:
+            raise StartupError(self._failures)
+
+
+def run_startup_hooks(injector, hooks, threads=1, profiler=None):
+    """Call each AppStartup hook with injection.
+
+    Hooks run in the order given, except where :func:`startup_after` declares
+    otherwise. With threads > 1 independent hooks run concurrently on that many
+    threads. Every hook that can run does so; failures are then raised together
+    as a :class:`StartupError`.
+    """
+    hooks = list(hooks)
+    index = dict((_hook_identity(hook), i) for i, hook in enumerate(hooks))
+    after = [
+        [index[dependency] for dependency in getattr(hook, '__startup_after__', ()) if dependency in index]
+        for hook in hooks
+    ]
+    tasks = [(describe(hook), partial(injector.call_with_injection, hook)) for hook in hooks]
+    _TaskRunner(tasks, after, 'startup', profiler or NullProfiler()).run(threads)
+
+
+def _is_singleton(binding):
+    scope = binding.scope
+    if isinstance(scope, ScopeDecorator):
+        scope = scope.scope
+    return scope is SingletonScope
+
+
+def _bindings(binder):
+    # injector (< 0.10, as pinned in setup.py) has no public API to list bindings.
+    return binder._bindings
+
+
+def warm_up_singletons(injector, interfaces=(), profiler=None, exclude=()):
+    """Construct singletons eagerly, rather than on first use.
+
+    Every singleton binding in the injector is constructed, along with any of
+    the given interfaces that are singletons (eg. @singleton classes that are
+    not explicitly bound), except those in exclude. Each is resolved with
+    injector.get(), so it is constructed under the injector's lock and only
+    once, even if other threads are already using the injector. Singletons
+    are therefore constructed one at a time. Every singleton that can be
+    constructed is; failures are then raised together as a :class:`WarmupError`.
+
+    :returns: A list of (name, seconds) construction times, slowest first.
+        A singleton's time includes that of any singletons it constructs.
+    """
+    profiler = profiler or NullProfiler()
+    binder = injector.binder
+    keys = set(key for key, binding in _bindings(binder).items() if _is_singleton(binding))
+    for interface in interfaces:
+        key = BindingKey(interface)
+        if _is_singleton(binder.get_binding(None, key)):
+            keys.add(key)
+    keys -= set(BindingKey(interface) for interface in exclude)
+
+    timings = []
+    failures = []
+    for key in sorted(keys, key=lambda k: describe(k.interface)):
+        name = describe(key.interface)
+        start = time.time()
+        try:
+            with profiler.timed('warmup', name):
+                injector.get(key.interface)
+        except Exception:
+            failures.append((name, traceback.format_exc()))
+        else:
+            timings.append((name, time.time() - start))
+    if failures:
+        raise WarmupError(failures)
+
+    timings.sort(key=lambda t: -t[1])
+    for name, elapsed in timings:
+        logger.info('Warmed up %s in %.1fms', name, elapsed * 1000.0)
+    return timings
@@ -0,0 +1,291 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+from injector import Injector, Key, inject, provides, singleton
+
+from .flags import AppStartup, Module, Warmup, create_injector_from_flags
+from .startup import StartupError, WarmupError, run_startup_hooks, startup_after, warm_up_singletons
+
+
+class SlowModule(Module):
+    @provides(AppStartup)
+    def provide_startup(self):
+        return [self.warm_up]
+
+    def warm_up(self):
+        pass
+
+    @provides(str, scope=singleton)
+    def provide_str(self):
+        return 'slow'
+
+
+def test_profile_startup_writes_json(tmpdir):
+    output = tmpdir.join('profile.json')
+    injector = create_injector_from_flags(
+        ['test', '--profile_startup', '--profile_startup_output', str(output)],
+        modules=['waffle.startup_test.SlowModule'])
+    assert injector.get(str) == 'slow'
+
+    report = json.loads(output.read())
+    phases = set((r['phase'], r['name']) for r in report['phases'])
+    assert ('import', 'waffle.startup_test.SlowModule') in phases
+    assert ('configure', 'SlowModule') in phases
+    assert ('startup', 'SlowModule.warm_up') in phases
+    assert ('provide', 'AppStartup') in phases
+
+
+def test_startup_is_not_profiled_by_default():
+    injector = create_injector_from_flags(['test'], modules=[SlowModule])
+    assert 'get' not in injector.__dict__
+
+
+class Hooks(object):
+    def __init__(self):
+        self.calls = []
+        self.barrier = threading.Event()
+
+    def first(self):
+        self.calls.append('first')
+
+    @startup_after(first)
+    def second(self):
+        self.calls.append('second')
+
+    def waits(self):
+        # Only completes if "releases" runs concurrently.
+        assert self.barrier.wait(5)
+        self.calls.append('waits')
+
+    def releases(self):
+        self.barrier.set()
+        self.calls.append('releases')
+
+    def fails(self):
+        raise ValueError('failed')
+
+    @startup_after(fails)
+    def after_failure(self):
+        self.calls.append('after_failure')
+
+    def exits(self):
+        sys.exit(1)
+
+    @startup_after(exits)
+    def after_exit(self):
+        self.calls.append('after_exit')
+
+
+def test_startup_hooks_respect_declared_order():
+    hooks = Hooks()
+    run_startup_hooks(Injector(), [hooks.second, hooks.first])
+    assert hooks.calls == ['first', 'second']
+
+
+def test_independent_startup_hooks_run_concurrently():
+    hooks = Hooks()
+    run_startup_hooks(Injector(), [hooks.waits, hooks.first, hooks.releases, hooks.second], threads=4)
+    assert sorted(hooks.calls) == ['first', 'releases', 'second', 'waits']
+    assert hooks.calls.index('first') < hooks.calls.index('second')
+
+
+def test_startup_failures_are_collected():
+    hooks = Hooks()
+    with pytest.raises(StartupError) as e:
+        run_startup_hooks(Injector(), [hooks.fails, hooks.after_failure, hooks.first, hooks.fails], threads=2)
+    assert [name for name, _ in e.value.failures].count('Hooks.fails') == 2
+    assert 'Hooks.after_failure' in [name for name, _ in e.value.failures]
+    assert hooks.calls == ['first']
+
+
+def test_startup_hooks_that_exit_are_failures():
+    hooks = Hooks()
+    errors = []
+
+    def run():
+        try:
+            run_startup_hooks(Injector(), [hooks.exits, hooks.after_exit, hooks.first], threads=2)
+        except StartupError as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert sorted(name for name, _ in errors[0].failures) == ['Hooks.after_exit', 'Hooks.exits']
+    assert hooks.calls == ['first']
+
+
+Slow = Key('Slow')
+Fast = Key('Fast')
+Dependent = Key('Dependent')
+
+
+@singleton
+class Unbound(object):
+    @inject(dependent=Dependent)
+    def __init__(self, dependent):
+        self.dependent = dependent
+
+
+class WarmupModule(Module):
+    def __init__(self):
+        self.constructed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def configure(self, binder):
+        binder.multibind(Warmup, to=[Unbound])
+
+    @provides(Slow, scope=singleton)
+    def provide_slow(self):
+        self.constructed.append('slow')
+        self.started.set()
+        self.release.wait(5)
+        return 'slow'
+
+    @provides(Fast, scope=singleton)
+    def provide_fast(self):
+        self.constructed.append('fast')
+        return 'fast'
+
+    @provides(Dependent, scope=singleton)
+    @inject(slow=Slow, fast=Fast)
+    def provide_dependent(self, slow, fast):
+        self.constructed.append('dependent')
+        return slow + fast
+
+
+CACHED_MODULE = '''
+from injector import provides
+from waffle.flags import Module
+
+
+class CachedModule(Module):
+    @provides(str)
+    def provide_str(self):
+        return %r
+'''
+
+START_WITH_CACHE = r'''
+import sys
+from waffle import flags
+
+scanned = []
+scan = flags._scan_providers
+flags._scan_providers = lambda cls: scanned.append(cls.__name__) or scan(cls)
+injector = flags.create_injector_from_flags(['test', '--bootstrap_cache', sys.argv[1]],
+                                           modules=['cached_module.CachedModule'])
+sys.stdout.write('%s %s' % (injector.get(str), ','.join(scanned)))
+'''
+
+
+def test_bootstrap_cache_is_used_by_later_starts(tmpdir):
+    source = tmpdir.join('cached_module.py')
+    cache = str(tmpdir.join('bootstrap.json'))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmpdir), root]), PYTHONDONTWRITEBYTECODE='1')
+
+    def start():
+        value, scanned = subprocess.check_output([sys.executable, '-c', START_WITH_CACHE, cache], env=env).split(' ')
+        return value, 'CachedModule' in scanned.split(',')
+
+    source.write(CACHED_MODULE % 'first')
+    assert start() == ('first', True)
+    assert start() == ('first', False)
+    # Touching the source does not change its hash.
+    mtime = source.mtime() + 10
+    source.setmtime(mtime)
+    assert start() == ('first', False)
+    source.write(CACHED_MODULE % 'changed')
+    source.setmtime(mtime + 10)
+    assert start() == ('changed', True)
+    assert start() == ('changed', False)
+
+
+def test_unwritable_bootstrap_cache_is_ignored(tmpdir):
+    class UncachedModule(SlowModule):
+        pass
+
+    cache = str(tmpdir.join('missing', 'bootstrap.json'))
+    injector = create_injector_from_flags(['test', '--bootstrap_cache=' + cache], modules=[UncachedModule])
+    assert injector.get(str) == 'slow'
+    assert not os.path.exists(cache)
+
+
+def test_warm_up_singletons():
+    module = WarmupModule()
+    injector = Injector([module])
+    timings = warm_up_singletons(injector, injector.get(Warmup))
+    assert sorted(module.constructed) == ['dependent', 'fast', 'slow']
+    assert set(name for name, _ in timings) >= set(['Slow', 'Fast', 'Dependent', 'Unbound'])
+    assert injector.get(Unbound) is injector.get(Unbound)
+    assert injector.get(Unbound).dependent == 'slowfast'
+
+
+def test_warm_up_singletons_constructs_each_singleton_once():
+    module = WarmupModule()
+    module.release.clear()
+    injector = Injector([module])
+    warmup = threading.Thread(target=warm_up_singletons, args=(injector,))
+    warmup.start()
+    assert module.started.wait(5)
+    # Another thread asks for Slow while warmup is constructing it.
+    user = threading.Thread(target=injector.get, args=(Slow,))
+    user.start()
+    user.join(0.1)
+    module.release.set()
+    warmup.join()
+    user.join()
+    assert module.constructed.count('slow') == 1
+
+
+def test_warmup_failures_are_collected():
+    Broken = Key('Broken')
+
+    def broken():
+        raise ValueError('broken')
+
+    injector = Injector(lambda binder: binder.bind(Broken, to=broken, scope=singleton))
+    injector.binder.bind(Fast, to='fast', scope=singleton)
+    with pytest.raises(WarmupError) as e:
+        warm_up_singletons(injector)
+    assert [name for name, _ in e.value.failures] == ['Broken']
+    assert 'failed to warm up' in str(e.value)
+    assert injector.get(Fast) == 'fast'
+
+
+def test_injector_bindings_can_be_listed():
+    # warm_up_singletons relies on the private Binder._bindings of the pinned injector.
+    injector = Injector([WarmupModule()])
+    assert set([Slow, Fast, Dependent]) <= set(key.interface for key in injector.binder._bindings)
+
+
+def test_warmup_flag():
+    module = WarmupModule()
+    create_injector_from_flags(['test', '--warmup'], modules=[module])
+    assert sorted(module.constructed) == ['dependent', 'fast', 'slow']
+
+
+def test_module_providers_are_scanned_once_per_class(monkeypatch):
+    from . import flags
+
+    scanned = []
+
+    def scan(cls):
+        scanned.append(cls)
+        return real_scan(cls)
+
+    class ScannedModule(SlowModule):
+        pass
+
+    real_scan = flags._scan_providers
+    monkeypatch.setattr(flags, '_scan_providers', scan)
+    for _ in range(2):
+        assert Injector([ScannedModule()]).get(str) == 'slow'
+    assert scanned == [ScannedModule]
@@ -3,10 +3,10 @@ from __future__ import absolute_import
 import codecs
 import os
 
-from injector import Module, MappingKey, inject, singleton, provides
+from injector import MappingKey, inject, singleton, provides
 from jinja2 import Environment, BaseLoader, TemplateNotFound, StrictUndefined
 
-from waffle.flags import Flag, FlagKey
+from waffle.flags import Flag, FlagKey, Module
 
 
 """Jinja2 based templating system for Waffle.
@@ -1,15 +1,24 @@
 from __future__ import absolute_import
 
+import logging
+import signal
 from datetime import timedelta
+from functools import partial
 
-from injector import Injector, Module, Scope, ScopeDecorator, InstanceProvider, \
+from injector import Injector, Scope, ScopeDecorator, InstanceProvider, \
     Key, Binder, SequenceKey, MappingKey, provides, inject, singleton
 from clastic import Application, Middleware as WebMiddleware, Request, render_basic
 from clastic.middleware.session import CookieSessionMiddleware, JSONCookie
+from clastic.static import StaticApplication
 from werkzeug.local import Local, LocalManager
 
-from waffle.flags import Flag, Flags
+from waffle.flags import Flag, Flags, Module, Warmup
 from waffle.util import parse_reltime
+from waffle.web.prefork import PreforkServer
+from waffle.web.server import SERVERS, listen
+
+
+logger = logging.getLogger(__name__)
 
 
 Routes = SequenceKey('Routes')
@@ -111,6 +120,7 @@ class WebApplication(Application):
             render_factory=RenderFactory)
     def __init__(self, middlewares, routes, resources, error_handlers, injector,
                  render_factory, **kwargs):
+        self._injector = injector
         # Make routes injectable.
         routes = [(p, (injector.wrap_function(f) if hasattr(f, '__bindings__') else f), r)
                   for p, f, r in routes]
@@ -125,9 +135,37 @@ class WebApplication(Application):
 
     @inject(flags=Flags)
     def serve(self, flags, **kwargs):
-        args = dict(address=flags.bind_address, port=flags.bind_port, use_reloader=flags.debug,
-                    static_path=flags.static_root, **kwargs)
-        return super(WebApplication, self).serve(**args)
+        """Serve the application.
+
+        --server selects the server engine, and --workers serves from that many
+        forked worker processes. By default clastic's development server is used.
+        """
+        if flags.server == 'development' and not flags.workers:
+            args = dict(address=flags.bind_address, port=flags.bind_port, use_reloader=flags.debug,
+                        static_path=flags.static_root, **kwargs)
+            return super(WebApplication, self).serve(**args)
+
+        if flags.static_root:
+            self.add(('/static', StaticApplication(flags.static_root)), index=0)
+        engine = 'threaded' if flags.server == 'development' else flags.server
+        make_server = partial(SERVERS[engine], threads=flags.server_threads, backlog=flags.server_backlog,
+                              keepalive_timeout=flags.keepalive_timeout, max_request_size=flags.max_request_size,
+                              graceful_timeout=flags.graceful_timeout)
+        sock = listen(flags.bind_address, flags.bind_port, flags.server_backlog)
+        if flags.workers:
+            server = PreforkServer(self._injector, self, flags.workers, sock=sock,
+                                   graceful_timeout=flags.graceful_timeout, make_server=make_server)
+            return server.serve()
+
+        sock.setblocking(0)
+        server = make_server(sock, self)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+        logger.info('Serving on %s:%d with the %s server', flags.bind_address, sock.getsockname()[1], engine)
+        try:
+            server.serve()
+        finally:
+            sock.close()
 
 
 class WebModule(Module):
@@ -139,6 +177,20 @@ class WebModule(Module):
     session_secret = Flag('--session_secret', help='Secret used to encrypt cookies', metavar='SECRET', required=True)
     server_address = Flag('--server_address', help='Fully qualified URL of server (excluding trailing slash).',
                           default='http://127.0.0.1:8080', metavar='URL')
+    server = Flag('--server', help='HTTP server engine.', choices=['development'] + sorted(SERVERS),
+                  default='development')
+    server_threads = Flag('--server_threads', help='Number of request threads for the threaded and eventloop '
+                          'servers.', metavar='N', type=int, default=16)
+    server_backlog = Flag('--server_backlog', help='Maximum number of pending connections.', metavar='N', type=int,
+                          default=128)
+    keepalive_timeout = Flag('--keepalive_timeout', help='Seconds to keep idle connections open for further requests '
+                             '(0 to close after each request).', metavar='SECONDS', type=int, default=5)
+    max_request_size = Flag('--max_request_size', help='Reject request bodies larger than this (0 for no limit).',
+                            metavar='BYTES', type=int, default=10 * 1024 * 1024)
+    workers = Flag('--workers', help='Serve from N forked worker processes, using the threaded server unless '
+                   '--server is given.', metavar='N', type=int, default=0)
+    graceful_timeout = Flag('--graceful_timeout', help='Seconds to wait for in-flight requests when stopping the '
+                            'server or restarting workers.', metavar='SECONDS', type=int, default=30)
 
     def configure(self, binder):
         binder.bind_scope(RequestScope)
@@ -149,6 +201,7 @@ class WebModule(Module):
         binder.bind(RenderFactory, to=None, scope=singleton)
         binder.bind(RequestScopeMiddleware)
         binder.multibind(Routes, to=_routes, scope=singleton)
+        binder.multibind(Warmup, to=[WebApplication])
 
     @provides(Middlewares)
     @inject(binder=Binder)
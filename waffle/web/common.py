@@ -1,13 +1,14 @@
 from injector import Module
 
-from waffle.web.db import DatabaseSessionModule
-from waffle.web.clastic import WebModule
-from waffle.web.csrf import CsrfModule
-from waffle.web.template import WebTemplateModule
-
 
 class WebModules(Module):
     def configure(self, binder):
+        # Imported here so that importing WebModules does not import the web stack.
+        from waffle.web.db import DatabaseSessionModule
+        from waffle.web.clastic import WebModule
+        from waffle.web.csrf import CsrfModule
+        from waffle.web.template import WebTemplateModule
+
         binder.install(WebModule)
         binder.install(DatabaseSessionModule)
         binder.install(WebTemplateModule)
@@ -3,21 +3,26 @@ from __future__ import absolute_import
 from injector import Module, inject, provides
 from clastic import Middleware
 
-from waffle.db import DatabaseSession
-from waffle.web.clastic import Middlewares
+from waffle.db import DatabaseSession, QueryInstrumentation, QueryStats
+from waffle.web.clastic import Middlewares, RequestScope
 
 
 class SQLAlchemyMiddleware(Middleware):
-    def __init__(self, session):
+    def __init__(self, session, instrumentation):
         self._session = session
+        self._instrumentation = instrumentation
 
     def request(self, next, _route):
-        if hasattr(_route.endpoint, '__transaction__'):
-            with self._session:
-                return next()
-        else:
+        # The session is removed after every request, so that sessions of
+        # short-lived scopes (eg. greenlets) are not retained.
+        with self._instrumentation.record():
             try:
-                return next()
+                if hasattr(_route.endpoint, '__transaction__'):
+                    readonly = getattr(_route.endpoint, '__transaction_readonly__', False)
+                    with self._session.readonly if readonly else self._session:
+                        return next()
+                else:
+                    return next()
             finally:
                 self._session.remove()
 
@@ -26,6 +31,12 @@ class DatabaseSessionModule(Module):
     """Manage SQLAlchemy session lifecycle."""
 
     @provides(Middlewares)
-    @inject(session=DatabaseSession)
-    def provide_db_middleware(self, session):
-        return [SQLAlchemyMiddleware(session)]
+    @inject(session=DatabaseSession, instrumentation=QueryInstrumentation)
+    def provide_db_middleware(self, session, instrumentation):
+        return [SQLAlchemyMiddleware(session, instrumentation)]
+
+    @provides(QueryStats, scope=RequestScope)
+    @inject(instrumentation=QueryInstrumentation)
+    def provide_request_query_stats(self, instrumentation):
+        """The statements executed by the current request."""
+        return instrumentation.current
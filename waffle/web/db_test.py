@@ -0,0 +1,30 @@
+from __future__ import absolute_import
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from waffle.db import ExplicitSession, ExplicitSessionManager, QueryInstrumentation, transaction
+from waffle.web.db import SQLAlchemyMiddleware
+
+
+class Route(object):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+
+@pytest.mark.parametrize('transactional', [True, False])
+def test_session_is_removed_after_each_request(transactional):
+    session = ExplicitSessionManager(sessionmaker(bind=create_engine('sqlite://'), autocommit=True,
+                                                  class_=ExplicitSession))
+    middleware = SQLAlchemyMiddleware(session, QueryInstrumentation())
+
+    def endpoint():
+        with session as s:
+            return s
+
+    if transactional:
+        endpoint = transaction(endpoint)
+    used = [middleware.request(lambda: endpoint(), Route(endpoint)) for _ in range(2)]
+    assert used[0] is not used[1]
+    assert not session._registry.has()
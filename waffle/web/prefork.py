@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import signal
+import time
+
+from waffle.flags import AfterFork, BeforeFork
+
+
+"""A pre-forking multi-process server for WebApplication.
+
+The injector is built once in the parent process, which then binds the
+listening socket and forks workers that share it. Workers inherit the
+already-constructed injector copy-on-write.
+
+Modules with fork-unsafe state contribute hooks to BeforeFork (called in the
+parent before each fork) and AfterFork (called in each worker).
+"""
+
+
+logger = logging.getLogger(__name__)
+
+
+class PreforkServer(object):
+    """Serve a WSGI application from forked worker processes.
+
+    - Workers that exit unexpectedly are restarted.
+    - SIGHUP replaces workers one at a time (a rolling restart). New workers
+      are forked from this process, so this does not load new code or
+      configuration; restart the server for that.
+    - SIGTERM and SIGINT stop workers gracefully, killing those that have not
+      exited after graceful_timeout seconds.
+
+    :param sock: An existing listening socket. If not given, one is bound to
+        address and port.
+    :param make_server: Called with (sock, app) in each worker to create one
+        of the servers in waffle.web.server. Defaults to ThreadedWSGIServer.
+    """
+
+    def __init__(self, injector, app, workers, address='127.0.0.1', port=8080, backlog=128,
+                 graceful_timeout=30, sock=None, make_server=None):
+        self._injector = injector
+        self._app = app
+        self._worker_count = workers
+        self._address = address
+        self._port = port
+        self._backlog = backlog
+        self._graceful_timeout = graceful_timeout
+        self._socket = sock
+        self._make_server = make_server
+        self._workers = {}
+        self._retiring = set()
+        self._stopping = False
+        self._reloading = False
+
+    def serve(self):
+        # The servers import werkzeug, so are only imported when serving.
+        from waffle.web.server import ThreadedWSGIServer, listen
+
+        if self._make_server is None:
+            self._make_server = ThreadedWSGIServer
+        if self._socket is None:
+            self._socket = listen(self._address, self._port, self._backlog)
+        # Workers compete to accept connections; those that lose must not block.
+        self._socket.setblocking(0)
+        logger.info('Serving on %s:%d with %d workers', self._socket.getsockname()[0],
+                    self._socket.getsockname()[1], self._worker_count)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        try:
+            for _ in range(self._worker_count):
+                self._spawn()
+            while not self._stopping:
+                self._reap()
+                if self._reloading:
+                    self._reloading = False
+                    self._rolling_restart()
+                time.sleep(0.1)
+        finally:
+            for pid in list(self._workers):
+                self._retire(pid, wait=False)
+            for pid in list(self._workers):
+                self._retire(pid)
+            self._socket.close()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _reload(self, signum, frame):
+        self._reloading = True
+
+    def _call_hooks(self, key):
+        for hook in self._injector.get(key):
+            self._injector.call_with_injection(hook)
+
+    def _spawn(self):
+        self._call_hooks(BeforeFork)
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker()
+        self._workers[pid] = time.time()
+        return pid
+
+    def _run_worker(self):
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._call_hooks(AfterFork)
+            server = self._make_server(self._socket, self._app)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.serve()
+        except Exception:
+            logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping or pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+            logger.warning('Worker %d exited with status %d, restarting', pid, status)
+            # Avoid a fork loop if workers are failing immediately.
+            if time.time() - started < 1:
+                time.sleep(1)
+            self._spawn()
+
+    def _rolling_restart(self):
+        logger.info('Restarting %d workers', len(self._workers))
+        for pid in list(self._workers):
+            if self._stopping:
+                return
+            # Workers that exited during the restart have already been replaced.
+            if pid not in self._workers:
+                continue
+            self._spawn()
+            self._retire(pid)
+
+    def _retire(self, pid, wait=True):
+        """Stop a worker gracefully, killing it after graceful_timeout seconds.
+
+        Other workers are reaped, and restarted if they exit, while waiting.
+        """
+        self._retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        if not wait:
+            return
+        deadline = time.time() + self._graceful_timeout
+        while pid in self._workers:
+            if time.time() >= deadline:
+                logger.warning('Worker %d did not stop within %ds, killing', pid, self._graceful_timeout)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self._workers.pop(pid, None)
+                self._retiring.discard(pid)
+                break
+            self._reap()
+            time.sleep(0.05)
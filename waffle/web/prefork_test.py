@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+
+import os
+import signal
+import time
+import urllib2
+
+from injector import Injector
+
+from waffle.flags import AfterFork, FlagsModule
+from waffle.web.prefork import PreforkServer
+from waffle.web.server import ThreadedWSGIServer, listen
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+
+def fetch(port):
+    return int(urllib2.urlopen('http://127.0.0.1:%d/' % port, timeout=5).read())
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError('timed out')
+
+
+def exited(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return True
+    return False
+
+
+def start_server(workers, tmpdir, graceful_timeout=5):
+    """Start a PreforkServer in a child process.
+
+    Workers whose pids are written to tmpdir/stubborn ignore SIGTERM.
+    """
+    after_fork = tmpdir.join('after_fork')
+    stubborn = tmpdir.join('stubborn')
+
+    def record_fork():
+        with open(str(after_fork), 'a') as fd:
+            fd.write('%d\n' % os.getpid())
+
+    def make_server(sock, app):
+        server = ThreadedWSGIServer(sock, app)
+        stop = server.stop
+
+        def stop_unless_stubborn():
+            if not stubborn.check() or str(os.getpid()) not in stubborn.read().split():
+                stop()
+        server.stop = stop_unless_stubborn
+        return server
+
+    injector = Injector([FlagsModule(['test'])])
+    injector.binder.multibind(AfterFork, to=[record_fork])
+    sock = listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            PreforkServer(injector, pid_app, workers, sock=sock, graceful_timeout=graceful_timeout,
+                          make_server=make_server).serve()
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+    sock.close()
+
+    def forked():
+        if not after_fork.check():
+            return []
+        pids = [int(line) for line in after_fork.read().split()]
+        return pids if len(pids) >= workers else []
+    return pid, port, forked
+
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGTERM)
+    assert wait_for(lambda: os.waitpid(pid, os.WNOHANG)[0]) == pid
+
+
+def test_prefork_server_restarts_crashed_workers(tmpdir):
+    pid, port, forked = start_server(2, tmpdir)
+    try:
+        workers = wait_for(forked)
+        assert len(workers) == 2
+        assert fetch(port) in workers
+
+        os.kill(workers[0], signal.SIGKILL)
+        restarted = wait_for(lambda: len(forked()) == 3 and forked())
+        assert restarted[2] not in workers
+        served = set(fetch(port) for _ in range(10))
+        assert workers[0] not in served
+        assert served <= set(restarted)
+    finally:
+        stop_server(pid)
+
+
+def test_prefork_server_rolling_restart_on_sighup(tmpdir):
+    pid, port, forked = start_server(2, tmpdir)
+    try:
+        workers = wait_for(forked)
+        os.kill(pid, signal.SIGHUP)
+        replaced = wait_for(lambda: len(forked()) == 4 and forked())
+        assert set(replaced[2:]).isdisjoint(workers)
+        # Replaced workers have stopped.
+        for worker in workers:
+            wait_for(lambda: exited(worker))
+        assert fetch(port) in replaced[2:]
+    finally:
+        stop_server(pid)
+
+
+def test_prefork_server_restarts_crashed_workers_during_rolling_restart(tmpdir):
+    pid, port, forked = start_server(2, tmpdir, graceful_timeout=3)
+    try:
+        workers = wait_for(forked)
+        tmpdir.join('stubborn').write('%d\n' % workers[0])
+        os.kill(pid, signal.SIGHUP)
+        wait_for(lambda: len(forked()) == 3)
+        # While the restart waits for the first worker to stop, the second crashes.
+        os.kill(workers[1], signal.SIGKILL)
+        restarted = wait_for(lambda: len(forked()) == 4 and forked(), timeout=1.5)
+        assert restarted[3] not in workers
+        wait_for(lambda: exited(workers[0]))
+        # The crashed worker was already replaced, so is not replaced again.
+        time.sleep(0.5)
+        assert len(forked()) == 4
+    finally:
+        stop_server(pid)
+
+
+def test_prefork_server_stops_during_rolling_restart(tmpdir):
+    pid, port, forked = start_server(2, tmpdir, graceful_timeout=3)
+    try:
+        workers = wait_for(forked)
+        tmpdir.join('stubborn').write('%d\n' % workers[0])
+        os.kill(pid, signal.SIGHUP)
+        wait_for(lambda: len(forked()) == 3)
+    finally:
+        stop_server(pid)
+    # The second worker was not replaced.
+    assert len(forked()) == 3
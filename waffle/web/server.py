@@ -0,0 +1,248 @@
+from __future__ import absolute_import
+
+import socket
+import threading
+import time
+from Queue import Queue
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+
+"""WSGI servers for serving a WebApplication outside of clastic's development server.
+
+Each server accepts connections on an existing listening socket, so that the
+socket can be shared by forked workers. serve() returns after stop() is
+called, which is safe to call from a signal handler.
+
+    sock = listen('127.0.0.1', 8080, backlog=256)
+    server = SERVERS['threaded'](sock, app, threads=32, backlog=256)
+    server.serve()
+"""
+
+
+def listen(address, port, backlog=128):
+    """Create a listening socket."""
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
+
+
+def limit_request_size(app, max_request_size):
+    """Wrap a WSGI application to reject request bodies larger than max_request_size bytes."""
+    body = 'Request body exceeds %d bytes.\n' % max_request_size
+
+    def limited_app(environ, start_response):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_request_size:
+            # Close the connection rather than reading the body we are rejecting.
+            start_response('413 Request Entity Too Large', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body))),
+                ('Connection', 'close'),
+                ])
+            return [body]
+        return app(environ, start_response)
+
+    return limited_app
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """A werkzeug request handler that supports HTTP/1.1 persistent connections.
+
+    Connections are closed after the server's keepalive_timeout seconds without a request.
+    """
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout or None
+        if self.server.keepalive_timeout:
+            self.protocol_version = 'HTTP/1.1'
+        WSGIRequestHandler.setup(self)
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        try:
+            length = int(environ['CONTENT_LENGTH'] or 0)
+        except ValueError:
+            length = 0
+        self._input = environ['wsgi.input'] = LimitedStream(self.rfile, length)
+        return environ
+
+    def run_wsgi(self):
+        WSGIRequestHandler.run_wsgi(self)
+        # Discard any unread body so that the next request can be parsed.
+        if not self.close_connection:
+            self._input.exhaust()
+
+
+class ListeningWSGIServer(BaseWSGIServer):
+    """A single-threaded werkzeug WSGI server that accepts connections on an existing listening socket."""
+
+    def __init__(self, sock, app, backlog=128, keepalive_timeout=5, max_request_size=None, graceful_timeout=30,
+                 **kwargs):
+        self._listener = sock
+        self._stopping = False
+        self.request_queue_size = backlog
+        self.keepalive_timeout = keepalive_timeout
+        self.graceful_timeout = graceful_timeout
+        if max_request_size:
+            app = limit_request_size(app, max_request_size)
+        host, port = sock.getsockname()[:2]
+        kwargs.setdefault('handler', KeepAliveRequestHandler)
+        super(ListeningWSGIServer, self).__init__(host, port, app, **kwargs)
+        # Check for stop() between requests.
+        self.timeout = 1
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self._listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_activate(self):
+        pass
+
+    def serve(self):
+        while not self._stopping:
+            self.handle_request()
+
+    def stop(self):
+        self._stopping = True
+
+
+class ThreadedWSGIServer(ListeningWSGIServer):
+    """Serve connections from a fixed pool of threads.
+
+    Each thread serves one connection at a time, including any subsequent
+    requests on it while it is kept alive.
+    """
+
+    multithread = True
+
+    def __init__(self, sock, app, threads=16, **kwargs):
+        super(ThreadedWSGIServer, self).__init__(sock, app, **kwargs)
+        self._connections = Queue()
+        self._threads = [threading.Thread(target=self._serve_connections, name='wsgi-%d' % i)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _serve_connections(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def serve(self):
+        for thread in self._threads:
+            thread.start()
+        try:
+            super(ThreadedWSGIServer, self).serve()
+        finally:
+            for thread in self._threads:
+                self._connections.put(None)
+            deadline = time.time() + self.graceful_timeout
+            for thread in self._threads:
+                thread.join(max(0, deadline - time.time()))
+
+
+class GeventWSGIServer(object):
+    """Serve each connection from its own greenlet, using gevent.pywsgi.
+
+    Application code must use cooperative I/O (eg. via gevent.monkey) for
+    requests to be served concurrently.
+    """
+
+    def __init__(self, sock, app, threads=None, backlog=128, keepalive_timeout=5, max_request_size=None,
+                 graceful_timeout=30):
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIHandler, WSGIServer
+
+        class KeepAliveHandler(WSGIHandler):
+            def handle(self):
+                self.socket.settimeout(keepalive_timeout or None)
+                return WSGIHandler.handle(self)
+
+            def read_request(self, raw_requestline):
+                result = WSGIHandler.read_request(self, raw_requestline)
+                if not keepalive_timeout:
+                    self.close_connection = True
+                return result
+
+        if max_request_size:
+            app = limit_request_size(app, max_request_size)
+        self._graceful_timeout = graceful_timeout
+        # backlog was applied when sock was created.
+        self._server = WSGIServer(sock, app, spawn=Pool(), handler_class=KeepAliveHandler)
+
+    def serve(self):
+        self._server.serve_forever(stop_timeout=self._graceful_timeout)
+
+    def stop(self):
+        # serve_forever() stops the server, waiting for in-flight requests, once it is closed.
+        self._server.close()
+
+
+class EventLoopWSGIServer(object):
+    """Serve connections from a pure-Python event loop, using waitress.
+
+    Connections are multiplexed by an asyncore loop in the calling thread and
+    requests are dispatched to a pool of threads.
+    """
+
+    def __init__(self, sock, app, threads=16, backlog=128, keepalive_timeout=5, max_request_size=None,
+                 graceful_timeout=30):
+        from waitress.server import create_server
+
+        # waitress calls listen() on the socket again, so must be given the same backlog.
+        kwargs = dict(sockets=[sock], threads=threads, backlog=backlog, channel_timeout=keepalive_timeout)
+        if max_request_size:
+            kwargs['max_request_body_size'] = max_request_size
+        self._graceful_timeout = graceful_timeout
+        self._stopping = False
+        self._server = create_server(app, **kwargs)
+
+    def _loop_once(self, timeout):
+        server = self._server
+        server.asyncore.loop(timeout=timeout, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+
+    def serve(self):
+        server = self._server
+        while not self._stopping:
+            self._loop_once(1)
+        # Stop accepting, then finish in-flight requests.
+        server.accepting = False
+        deadline = time.time() + self._graceful_timeout
+        while time.time() < deadline and any(channel.requests or channel.total_outbufs_len
+                                             for channel in server.active_channels.values()):
+            self._loop_once(0.1)
+        server.task_dispatcher.shutdown(timeout=max(0, deadline - time.time()))
+
+    def stop(self):
+        self._stopping = True
+
+
+# Server engines selectable with --server.
+SERVERS = {
+    'threaded': ThreadedWSGIServer,
+    'gevent': GeventWSGIServer,
+    'eventloop': EventLoopWSGIServer,
+}
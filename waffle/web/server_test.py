@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import httplib
+import os
+import signal
+import time
+
+import pytest
+
+from waffle.web.server import SERVERS, listen
+
+
+ENGINES = {'gevent': 'gevent', 'eventloop': 'waitress'}
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    body = '%d:%s' % (os.getpid(), body)
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+@pytest.fixture(params=sorted(SERVERS))
+def server(request):
+    if request.param in ENGINES:
+        pytest.importorskip(ENGINES[request.param])
+    sock = listen('127.0.0.1', 0)
+    sock.setblocking(0)
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            server = SERVERS[request.param](sock, echo_app, threads=4, keepalive_timeout=5, max_request_size=100)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.serve()
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+    port = sock.getsockname()[1]
+    sock.close()
+    yield port
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + 10
+    while time.time() < deadline and not os.waitpid(pid, os.WNOHANG)[0]:
+        time.sleep(0.05)
+    else:
+        if time.time() >= deadline:
+            os.kill(pid, signal.SIGKILL)
+            pytest.fail('server did not stop')
+
+
+def test_server_keeps_connections_alive(server):
+    connection = httplib.HTTPConnection('127.0.0.1', server, timeout=5)
+    connection.request('POST', '/', 'first')
+    response = connection.getresponse()
+    pid, body = response.read().split(':')
+    assert response.status == 200
+    assert body == 'first'
+    connection.request('POST', '/', 'second')
+    response = connection.getresponse()
+    assert response.read() == pid + ':second'
+    connection.close()
+
+
+def test_server_rejects_large_requests(server):
+    connection = httplib.HTTPConnection('127.0.0.1', server, timeout=5)
+    connection.request('POST', '/', 'x' * 101)
+    response = connection.getresponse()
+    assert response.status == 413
+    connection.close()